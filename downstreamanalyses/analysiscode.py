@@ -1,11 +1,10 @@
 import os
+import logging
+import contextlib
 import pandas as pd
-import numpy as np
-import statsmodels.api as sm
-from lifelines import CoxPHFitter
-from lifelines.utils import k_fold_cross_validation  # kept even if not used, safe to remove if you prefer
 from microbiome_utils import *  # uses process() and helpers
-from patsy import dmatrices
+from association_utils import *  # per-unit association runs, result collection and the process pool
+from profiling_utils import PROFILER  # stage timers and fit counters, on with profile="yes"
 
 # reads paths and settings from environment variables provided by sbatch --export
 taxonomy = os.getenv('taxonomy')  # path to taxonomy artifact
@@ -19,6 +18,15 @@ cohortname = os.getenv('cohortname')  # file with cohort label (single line)
 subsfile = os.getenv('subsfile')  # file with subset names (one per line)
 label = os.getenv('label', '16s')  # gets label from environment, defaults to '16s'
 factors_str = os.getenv('factors', 'NA')  # study-specific categorical covariates as comma-separated string
+batched_ols = env_flag('batched_ols', 'yes')  # fits all continuous-outcome features in one batched solve instead of one sm.OLS per feature
+batched_cox = env_flag('batched_cox', 'yes')  # fits mortality features on shared risk sets, warm-started from the covariate-only model
+precompute = env_flag('precompute')  # builds diversity and CLR features once for all eligible samples instead of per model
+resume = env_flag('resume')  # skips subset/outcome/model units finished by an earlier, interrupted run
+provenance = env_flag('provenance', 'yes')  # 'no' keeps tables in memory and uses the native filter/diversity code, no QIIME2 artifacts in between
+profile = env_flag('profile')  # writes per-stage timings, peak memory and fit counts next to the results file
+feature_store = os.getenv('feature_store', '')  # with precompute, path prefix of a memory-mapped feature frame (<prefix>.npy/.json) reused by later runs
+cache_dir = os.getenv('cache_dir', '')  # directory for cached diversity results, no caching if empty
+cache_size = float(os.getenv('cache_size', '5'))  # cache size limit in GB, least recently used entries go first
 
 # removes outer single quotes if they were passed in sbatch as "'A,B'"
 if factors_str.startswith("'") and factors_str.endswith("'"):
@@ -26,16 +34,15 @@ if factors_str.startswith("'") and factors_str.endswith("'"):
 
 factors = factors_str.split(',')  # turns "A,B" into ["A","B"]
 
+# failed fits and other events are logged as one JSON object per line
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+PROFILER.enabled = profile
+
 print(threads)  # quick log of threads
 print(factors)  # quick log of factors
 print('imported environments')
 
-# prepares an empty results dataframe with consistent columns
-results_df = pd.DataFrame(columns=[
-    'Datasplit', 'Outcome', 'Variable', 'Model', 'N', 'Ncases', 'Coefficient',
-    'Std.Error', 'HR', 'LL', 'UL', 't.value', 'P'
-])
-
 # loads model list, outcome list, cohort label, and subset list
 with open(modsfile, 'r') as file:
     models = file.read().splitlines()  # each line is a base model string like 'sex+ppump'
@@ -48,29 +55,73 @@ with open(subsfile, 'r') as file:
 
 print('read files')
 
+# collects results in typed chunks; each flush appends only the new rows to the intermediate file
+results = ResultCollector(intermediate=intermediate_path(label, cohort))
+
 # stores original metadata columns to help exclude them from the features to test
-variables_store = pd.read_csv(metadata, sep='\t', dtype=str).columns.str.lower()
+variables_store = metadata_columns(metadata)  # header only
+schema = ColumnSchema(variables_store)  # sanitized names and column roles, shared by all units
 
 print('stored variables, will start for loop')
 
-# loops over all subset × outcome × model combinations
-for subs in subsets:
-    print(f"Performing analyses of {subs}")
-    for out in outcomes:
-        for model in models:
-            original_model = model  # keeps the original for resetting later
-
-            # adds age unless the outcome itself is age or mortality
-            if out not in ["age", "mortality"]:
-                model = f"{model}+age"
-
-            # removes sex from the model when analyzing only men
-            if "men" in subs:
-                model = model.replace("sex+", "").replace("sex", "")
-
-            model_terms = model.split('+')  # splits model into individual terms
-
-            # builds the analysis dataset using QIIME2 artifacts and diversity metrics
+# reuses alpha and nearest-neighbour beta diversities across models, reruns and resumed jobs
+cache = DiversityCache(cache_dir, max_bytes=int(cache_size * 1024 ** 3)) if cache_dir else None
+
+# with resume, finished units and the feature frame are kept in a checkpoint tied to these inputs and settings
+checkpoint = None
+if resume:
+    checkpoint = RunCheckpoint(
+        f"./intermediatefiles/checkpoint_{cohort}_{label}",
+        run_fingerprint(
+            [taxonomy, tree, feature_table, metadata, modsfile, outsfile, subsfile],
+            (label, factors, precompute, batched_ols, batched_cox, provenance, cache_dir)
+        )
+    )
+finished = checkpoint.completed() if checkpoint is not None else set()
+
+# with precompute, the feature frame is built once and each dataset below is a row filter of it
+if precompute:
+    # subset masks, missingness and factor codes are computed once and combined per model
+    with PROFILER.stage('read_metadata'):
+        meta = SubsetIndex(read_metadata(metadata, columns=required_metadata_columns(models, outcomes, factors)))
+
+    # a stored frame is memory-mapped instead of rebuilt, as long as it was built from these inputs
+    feature_fingerprint = run_fingerprint([taxonomy, tree, feature_table, metadata], (label, provenance))
+    feature_source = MappedFrame.open(feature_store, feature_fingerprint) if feature_store else None
+    if feature_source is None and checkpoint is not None:
+        feature_source = checkpoint.load_features()
+    if feature_source is None:
+        with PROFILER.stage('build_features'):
+            feature_source = build_features(
+                taxonomy=taxonomy,
+                tree=tree,
+                feature_table=feature_table,
+                threads=threads,
+                sample_ids=eligible_samples(meta),
+                label=label,
+                cache=cache,
+                provenance=provenance
+            )
+        if feature_store:
+            feature_source = MappedFrame.save(feature_source, feature_store, feature_fingerprint)
+        elif checkpoint is not None:
+            feature_source = checkpoint.save_features(feature_source)
+    features = feature_source.frame() if isinstance(feature_source, MappedFrame) else feature_source
+    print('created feature frame for all eligible samples')
+
+# every subset × outcome × model combination is an independent unit of work
+units = [(subs, out, model) for subs in subsets for out in outcomes for model in models]
+
+# builds one unit's dataset and runs its associations
+def analyse(unit):
+    subs, out, model = unit
+    model = unit_model(model, subs, out)  # adds age / drops sex as the subset and outcome require
+
+    # builds the analysis dataset using QIIME2 artifacts and diversity metrics
+    with PROFILER.stage('dataset', subset=subs, outcome=out, model=model):
+        if precompute:
+            datafile = process_precomputed(meta, features, model=model, sub=subs, out=out, factors=factors)
+        else:
             datafile = process(
                 taxonomy=taxonomy,
                 tree=tree,
@@ -82,103 +133,45 @@ for subs in subsets:
                 sub=subs,
                 out=out,
                 factors=factors,
-                label=label  # passes label so species-level is included for metagenomics
-            )
-
-            # standardizes column names to avoid patsy/formula issues
-            datafile.columns = datafile.columns.str.replace('-', '_')  # replaces dashes with underscores
-            datafile.columns = datafile.columns.str.replace(' ', '_')  # replaces spaces with underscores
-            datafile.columns = datafile.columns.str.replace('[^0-9a-zA-Z_]', '', regex=True)  # removes other special chars
-
-            print('created dataset, now continue with analyses')
-
-            # selects candidate variables to test (excludes original metadata cols and model covariate dummies)
-            variables = [
-                col for col in datafile.columns
-                if col not in variables_store and not any(col.startswith(term + '_') for term in model_terms)
-            ]
-
-            # runs OLS for continuous outcomes and Cox PH for mortality
-            for var in variables:
-                if out != "mortality":
-                    # builds formula "out ~ model + var"
-                    formula = f"{out} ~ {model} + {var}"
-                    datafile[out] = pd.to_numeric(datafile[out])  # ensures numeric outcome
-                    y, X = dmatrices(formula, data=datafile, return_type='dataframe')  # constructs design matrices
-                    lmmodel = sm.OLS(y, X).fit()  # fits linear model
-                    coefficients = lmmodel.summary2().tables[1]  # extracts coefficient table
-                    variable = var  # the tested feature
-
-                    # appends one row with estimates for the tested feature
-                    result_row = pd.DataFrame([{
-                        'Datasplit': subs,
-                        'Outcome': out,
-                        'Variable': var,
-                        'Model': model,
-                        'N': len(lmmodel.fittedvalues),
-                        'Ncases': np.nan,
-                        'Coefficient': coefficients.loc[variable, 'Coef.'],
-                        'Std.Error': coefficients.loc[variable, 'Std.Err.'],
-                        'HR': np.nan,
-                        'LL': coefficients.loc[variable, '[0.025'],
-                        'UL': coefficients.loc[variable, '0.975]'],
-                        't.value': coefficients.loc[variable, 't'],
-                        'P': coefficients.loc[variable, 'P>|t|']
-                    }])
-                    results_df = pd.concat([results_df, result_row], ignore_index=True)
-                else:
-                    # creates attained-age time scale: followup = studytime + age
-                    datafile['followup'] = datafile['studytime'] + datafile['age']
-
-                    # builds covariate list including model terms and the tested feature
-                    covariates = model_terms + [var]
-                    covariates = [cov.strip() for cov in covariates]  # trims whitespace
-
-                    # maps to the actual encoded columns (incl. one-hot dummies)
-                    covariates_use = [col for col in datafile.columns if any(cov in col for cov in covariates)]
-
-                    cph = CoxPHFitter()
-                    try:
-                        # fits Cox model using attained-age follow-up and mortality as event
-                        cph.fit(
-                            datafile[covariates_use + ['followup', 'mortality']],
-                            duration_col='followup',
-                            event_col='mortality'
-                        )
-                        coefficients = cph.summary  # coefficient table from lifelines
-                        variable = var  # the tested feature
-
-                        # appends one row with estimates for the tested feature
-                        result_row = pd.DataFrame([{
-                            'Datasplit': subs,
-                            'Outcome': out,
-                            'Variable': var,
-                            'Model': model,
-                            'N': cph._n_examples,
-                            'Ncases': cph.event_observed.sum(),
-                            'Coefficient': coefficients.loc[variable, 'coef'],
-                            'Std.Error': coefficients.loc[variable, 'se(coef)'],
-                            'HR': coefficients.loc[variable, 'exp(coef)'],
-                            'LL': coefficients.loc[variable, 'exp(coef) lower 95%'],
-                            'UL': coefficients.loc[variable, 'exp(coef) upper 95%'],
-                            't.value': np.nan,
-                            'P': coefficients.loc[variable, 'p']
-                        }])
-                        results_df = pd.concat([results_df, result_row], ignore_index=True)
-                    except Exception as e:
-                        print(f"Failed CoxPH fit for variable '{var}' in subset '{subs}' with outcome '{out}'. Error: {e}")  # logs failure reason
-                        print(f"Covariates used: {covariates_use}")  # logs which columns were used
-                        continue  # moves on to the next variable
-
-            # writes an intermediate CSV after each model to help monitor progress
-            results_df.to_csv(
-                f"./intermediatefiles/Results_{label}_{subs}_{cohort}_{pd.Timestamp.today().date()}.csv",
-                index=False
+                label=label,  # passes label so species-level is included for metagenomics
+                cache=cache,
+                provenance=provenance
             )
 
-            model = original_model  # resets model string for the next loop iteration
-
-    print(f"Finished analyses of {subs}")
+    print('created dataset, now continue with analyses')
+    with PROFILER.stage('associations', subset=subs, outcome=out, model=model):
+        return run_unit(datafile, subs, out, model, schema, batched_ols=batched_ols, batched_cox=batched_cox)
+
+# units finished by an earlier run are read back from the checkpoint instead of being rerun
+todo = [unit for unit in units if RunCheckpoint.unit_id(unit) not in finished]
+print(f"{len(units) - len(todo)} of {len(units)} units already finished")
+
+# with a precomputed feature frame, units run on a pool of `threads` processes sharing that frame
+if precompute and threads > 1:
+    fresh_results = run_units_parallel(
+        todo, meta, feature_source, factors, schema, threads,
+        batched_ols=batched_ols, batched_cox=batched_cox
+    )
+else:
+    fresh_results = (analyse(unit) for unit in todo)
+
+# results are collected in unit order, so the output does not depend on the number of workers or restarts
+# closing() shuts the pool down and frees the shared frame even when collecting a unit fails
+with contextlib.closing(fresh_results):
+    for unit in units:
+        subs, out, model = unit
+        if RunCheckpoint.unit_id(unit) in finished:
+            unit_frame = checkpoint.load_unit(unit)
+        else:
+            unit_frame = next(fresh_results)
+            if checkpoint is not None:
+                checkpoint.save_unit(unit, unit_frame)
+        results.extend(unit_frame)
+        results.flush()  # appends this unit's rows to the intermediate file to help monitor progress
+        print(f"Finished analyses of {subs}, {out}, {model}")
 
 # writes the final combined results CSV at the end
-results_df.to_csv(f"Results_{cohort}_{label}_{pd.Timestamp.today().date()}.csv", index=False)
+results.close()
+results_prefix = f"Results_{cohort}_{label}_{pd.Timestamp.today().date()}"
+results.to_csv(f"{results_prefix}.csv")
+PROFILER.write(results_prefix)  # only with profile="yes"
@@ -4,7 +4,8 @@ import numpy as np
 import statsmodels.api as sm
 from lifelines import CoxPHFitter
 from lifelines.utils import k_fold_cross_validation
-from microbiome_utils_fixed_alex3 import *
+from microbiome_utils import *
+from association_utils import ResultCollector, intermediate_path, MappedFrame, run_fingerprint, ColumnSchema
 from patsy import dmatrices
 
 # Fill in the right filepaths
@@ -19,6 +20,7 @@ outsfile = 'outs_agingmicrobiome.txt'
 cohortname = 'cohort.txt'
 subsfile = 'subsets_agingmicrobiome.txt'
 factors_str = 'NA'
+feature_store = ''  # optional path prefix, e.g. 'intermediatefiles/features_16s': builds the features once for all participants and keeps them memory-mapped for later runs
 
 #----------------------------------------------------#
 ##   Do not change anything underneath these lines  ##
@@ -33,11 +35,6 @@ print(threads)
 print(factors)
 print('imported environments')
 
-results_df = pd.DataFrame(columns=[
-    'Datasplit', 'Outcome', 'Variable', 'Model', 'N', 'Ncases', 'Coefficient',
-    'Std.Error', 'HR', 'LL','UL','t.value', 'P'
-])
-
 with open(modsfile, 'r') as file:
     models = file.read().splitlines()
 with open(outsfile, 'r') as file:
@@ -49,10 +46,24 @@ with open(subsfile, 'r') as file:
 
 print('read files')
 
-variables_store = pd.read_csv(metadata, sep='\t', dtype=str).columns.str.lower()
+results = ResultCollector(intermediate=intermediate_path(label, cohort))
+
+variables_store = metadata_columns(metadata)  # header only
+schema = ColumnSchema(variables_store)  # sanitized names and column roles, shared by all models
 
 print('stored variables, will start for loop')
 
+if feature_store:
+    meta = SubsetIndex(read_metadata(metadata, columns=required_metadata_columns(models, outcomes, factors)))
+    feature_fingerprint = run_fingerprint([taxonomy, tree, feature_table, metadata], (label, True))
+    stored_features = MappedFrame.open(feature_store, feature_fingerprint)
+    if stored_features is None:
+        stored_features = MappedFrame.save(
+            build_features(taxonomy, tree, feature_table, threads, eligible_samples(meta), label=label),
+            feature_store, feature_fingerprint
+        )
+    features = stored_features.frame()
+
 for subs in subsets:
     print(f"Performing analyses of {subs}")
     for out in outcomes:
@@ -63,28 +74,26 @@ for subs in subsets:
             if "men" in subs:
                 model = model.replace("sex+", "").replace("sex", "")
             model_terms = model.split('+')
-            datafile = process(
-                taxonomy=taxonomy,
-                tree=tree,
-                feature_table=feature_table,
-                output=cohort,
-                threads=threads,
-                metadata=metadata,
-                model=model,
-                sub=subs,
-                out=out,
-                factors=factors,
-                label=label
-            )
-            datafile.columns = datafile.columns.str.replace('-', '_')
-            datafile.columns = datafile.columns.str.replace(' ', '_')
-            datafile.columns = datafile.columns.str.replace('[^0-9a-zA-Z_]', '', regex=True)
+            if feature_store:
+                datafile = process_precomputed(meta, features, model=model, sub=subs, out=out, factors=factors)
+            else:
+                datafile = process(
+                    taxonomy=taxonomy,
+                    tree=tree,
+                    feature_table=feature_table,
+                    output=cohort,
+                    threads=threads,
+                    metadata=metadata,
+                    model=model,
+                    sub=subs,
+                    out=out,
+                    factors=factors,
+                    label=label
+                )
+            datafile = schema.sanitize(datafile)
 
             print('created dataset, now continue with analyses')
-            variables = [
-                col for col in datafile.columns 
-                if col not in variables_store and not any(col.startswith(term + '_') for term in model_terms)
-            ]
+            variables = schema.features(datafile, model_terms)
             for var in variables:
                 if out != "mortality":
                     formula = f"{out} ~ {model} + {var}"
@@ -93,7 +102,7 @@ for subs in subsets:
                     lmmodel = sm.OLS(y, X).fit()
                     coefficients = lmmodel.summary2().tables[1]
                     variable = var
-                    result_row = pd.DataFrame([{
+                    results.add(**{
                         'Datasplit': subs,
                         'Outcome': out,
                         'Variable': var,
@@ -107,19 +116,16 @@ for subs in subsets:
                         'UL': coefficients.loc[variable, '0.975]'],
                         't.value': coefficients.loc[variable, 't'],
                         'P': coefficients.loc[variable, 'P>|t|']
-                    }])
-                    results_df = pd.concat([results_df, result_row], ignore_index=True)
+                    })
                 else:
                     datafile['followup'] = datafile['studytime'] + datafile['age']
-                    covariates = model_terms + [var]
-                    covariates = [cov.strip() for cov in covariates]
-                    covariates_use = [col for col in datafile.columns if any(cov in col for cov in covariates)]
+                    covariates_use = schema.covariates(datafile, model_terms) + [var]
                     cph = CoxPHFitter()
                     try:
                         cph.fit(datafile[covariates_use + ['followup', 'mortality']], duration_col='followup', event_col='mortality')
                         coefficients = cph.summary
                         variable = var
-                        result_row = pd.DataFrame([{
+                        results.add(**{
                             'Datasplit': subs,
                             'Outcome': out,
                             'Variable': var,
@@ -133,17 +139,17 @@ for subs in subsets:
                             'UL': coefficients.loc[variable, 'exp(coef) upper 95%'],
                             't.value': np.nan,
                             'P': coefficients.loc[variable, 'p']
-                        }])
-                        results_df = pd.concat([results_df, result_row], ignore_index=True)
+                        })
                     except Exception as e:
                         print(f"Failed CoxPH fit for variable '{var}' in subset '{subs}' with outcome '{out}'. Error: {e}")
                         print(f"Covariates used: {covariates_use}")
                         continue
-            results_df.to_csv(f"./intermediatefiles/Results_{label}_{subs}_{cohort}_{pd.Timestamp.today().date()}.csv", index=False)
+            results.flush()
             model = original_model
     print(f"Finished analyses of {subs}")
 
-results_df.to_csv(f"Results_{cohort}_{label}_{pd.Timestamp.today().date()}.csv", index=False)
+results.close()
+results.to_csv(f"Results_{cohort}_{label}_{pd.Timestamp.today().date()}.csv")
 
 if __name__ == '__main__':
     process()
@@ -0,0 +1,706 @@
+import os
+import re
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from scipy import stats
+from patsy import dmatrices
+from lifelines import CoxPHFitter
+from microbiome_utils import process_precomputed
+from profiling_utils import PROFILER
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+OLS_COLUMNS = ['N', 'Coefficient', 'Std.Error', 'LL', 'UL', 't.value', 'P']
+COX_COLUMNS = ['N', 'Ncases', 'Coefficient', 'Std.Error', 'HR', 'LL', 'UL', 'P']
+
+logger = logging.getLogger('agingmicrobiome.association')
+
+RESULT_COLUMNS = [
+    'Datasplit', 'Outcome', 'Variable', 'Model', 'N', 'Ncases', 'Coefficient',
+    'Std.Error', 'HR', 'LL', 'UL', 't.value', 'P'
+]
+
+# N is a nullable integer ("57"); Ncases is a float ("114.0", "" for OLS rows) as in the old
+# table, where the NaN of the OLS rows that come first made the whole column float
+RESULT_DTYPES = {
+    'Datasplit': object, 'Outcome': object, 'Variable': object, 'Model': object,
+    'N': 'Int64', 'Ncases': 'float64', 'Coefficient': 'float64', 'Std.Error': 'float64',
+    'HR': 'float64', 'LL': 'float64', 'UL': 'float64', 't.value': 'float64', 'P': 'float64'
+}
+
+# Covariate-only design "out ~ model" on the rows patsy keeps
+def covariate_design(datafile, out, model):
+    terms = [term for term in model.split('+') if term.strip()]
+    rhs = '+'.join(terms) if terms else '1'
+    y, X = dmatrices(f"{out} ~ {rhs}", data=datafile, return_type='dataframe')
+    return y.iloc[:, 0], X
+
+# Orthonormal basis of the covariate columns; rank-deficient designs fall back to SVD like statsmodels' pinv
+def covariate_basis(X):
+    X = np.asarray(X, dtype=float)
+    eps = np.finfo(float).eps * max(X.shape)
+    q, r = np.linalg.qr(X)
+    diag = np.abs(np.diag(r))
+    if diag.size and (diag > diag.max() * eps).all():
+        return q
+    u, s, _ = np.linalg.svd(X, full_matrices=False)
+    return u[:, s > s.max() * eps]
+
+# Coefficient and standard error of each feature column added to the covariates (Frisch-Waugh-Lovell)
+def _scan_block(X, y, F):
+    Q = covariate_basis(X)
+    ry = y - Q @ (Q.T @ y)
+    RF = F - Q @ (Q.T @ F)
+    sxx = np.einsum('ij,ij->j', RF, RF)
+    sxy = RF.T @ ry
+    df_resid = len(y) - Q.shape[1] - 1
+
+    # features that are (numerically) a linear combination of the covariates cannot be estimated
+    scale = np.einsum('ij,ij->j', F, F)
+    estimable = (sxx > scale * np.finfo(float).eps * max(F.shape)) & (df_resid > 0)
+    sxx = np.where(estimable, sxx, np.nan)
+
+    coef = sxy / sxx
+    rss = ry @ ry - coef * sxy
+    se = np.sqrt(rss / df_resid / sxx)
+    return coef, se, df_resid
+
+# Mass-univariate OLS of "out ~ model + var" for every var, same estimates as sm.OLS per feature
+def ols_scan(datafile, out, model, variables):
+    y, X = covariate_design(datafile, out, model)
+    y = y.to_numpy(dtype=float)
+    Xv = X.to_numpy(dtype=float)
+    F = datafile.loc[X.index, list(variables)].to_numpy(dtype=float)
+
+    n = np.full(F.shape[1], len(y))
+    coef = np.full(F.shape[1], np.nan)
+    se = np.full(F.shape[1], np.nan)
+    df_resid = np.full(F.shape[1], np.nan)
+
+    # complete feature columns share one factorization
+    missing = np.isnan(F)
+    complete = ~missing.any(axis=0)
+    if complete.any():
+        coef[complete], se[complete], df_resid[complete] = _scan_block(Xv, y, F[:, complete])
+
+    # features with missing values drop their own rows, as dmatrices would
+    for j in np.flatnonzero(~complete):
+        rows = ~missing[:, j]
+        n[j] = rows.sum()
+        if n[j] > Xv.shape[1] + 1:
+            c, s, d = _scan_block(Xv[rows], y[rows], F[rows][:, [j]])
+            coef[j], se[j], df_resid[j] = c[0], s[0], d
+
+    t_value = coef / se
+    t_crit = stats.t.ppf(0.975, df_resid)
+    return pd.DataFrame({
+        'N': n,
+        'Coefficient': coef,
+        'Std.Error': se,
+        'LL': coef - t_crit * se,
+        'UL': coef + t_crit * se,
+        't.value': t_value,
+        'P': 2 * stats.t.sf(np.abs(t_value), df_resid)
+    }, index=pd.Index(variables, name='Variable'), columns=OLS_COLUMNS)
+
+# Casts result rows to the fixed column order and dtypes of the results table
+def as_results(frame):
+    frame = frame.reindex(columns=RESULT_COLUMNS)
+    return frame.astype(RESULT_DTYPES).reset_index(drop=True)
+
+# Collects association results in typed column chunks instead of growing one DataFrame row by row.
+# flush() turns buffered rows into a chunk and appends only that chunk to the intermediate file
+# (Parquet row groups when pyarrow is available, otherwise CSV appends).
+class ResultCollector:
+    def __init__(self, intermediate=None):
+        self.intermediate = intermediate
+        if intermediate is not None and os.path.exists(intermediate):
+            os.remove(intermediate)  # the intermediate file always mirrors this collector
+        self._rows = {col: [] for col in RESULT_COLUMNS}
+        self._chunks = []
+        self._writer = None
+        self._flushed = 0
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._chunks) + len(self._rows['Variable'])
+
+    # One result row given as keyword arguments; missing columns become NA
+    def add(self, **row):
+        for col in RESULT_COLUMNS:
+            self._rows[col].append(row.get(col, np.nan))
+
+    # Many result rows at once, e.g. a whole batched OLS scan
+    def extend(self, frame):
+        self._stage_rows()
+        self._chunks.append(as_results(frame))
+
+    def _stage_rows(self):
+        if self._rows['Variable']:
+            self._chunks.append(as_results(pd.DataFrame(self._rows, columns=RESULT_COLUMNS)))
+            self._rows = {col: [] for col in RESULT_COLUMNS}
+
+    def flush(self):
+        self._stage_rows()
+        new_chunks = self._chunks[self._flushed:]
+        self._flushed = len(self._chunks)
+        if self.intermediate is None or not new_chunks:
+            return
+        new_rows = pd.concat(new_chunks, ignore_index=True)
+        if pa is not None and self.intermediate.endswith('.parquet'):
+            table = pa.Table.from_pandas(new_rows, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.intermediate, table.schema)
+            self._writer.write_table(table)
+        else:
+            write_header = not os.path.exists(self.intermediate) or os.path.getsize(self.intermediate) == 0
+            new_rows.to_csv(self.intermediate, mode='a', header=write_header, index=False)
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def to_frame(self):
+        self._stage_rows()
+        if not self._chunks:
+            return as_results(pd.DataFrame(columns=RESULT_COLUMNS))
+        return pd.concat(self._chunks, ignore_index=True)
+
+    # Final results table, same layout as the former results_df.to_csv(..., index=False)
+    def to_csv(self, path):
+        self.to_frame().to_csv(path, index=False)
+
+# Intermediate file for monitoring a run. CSV can be read while the run is going;
+# Parquet (needs pyarrow) is smaller but only readable once the collector is closed.
+def intermediate_path(label, cohort, fmt='csv', directory='./intermediatefiles'):
+    if fmt == 'parquet' and pa is None:
+        fmt = 'csv'
+    return os.path.join(directory, f"Results_{label}_{cohort}_{pd.Timestamp.today().date()}.{fmt}")
+
+# Raised when a Cox fit does not reach a maximum of the partial likelihood
+class CoxConvergenceError(Exception):
+    pass
+
+# Risk-set structure of one follow-up / event sample, built once and shared by every feature's fit.
+# Rows are sorted by descending follow-up, so each risk set is a prefix and its sums are cumulative
+# sums; ties are handled with Efron's method like lifelines' CoxPHFitter.
+class CoxRiskSets:
+    def __init__(self, durations, events):
+        durations = np.asarray(durations, dtype=float)
+        self.order = np.argsort(-durations, kind='stable')
+        times = durations[self.order]
+        observed = np.asarray(events, dtype=float)[self.order] > 0
+        self.n = len(times)
+        self.n_events = int(observed.sum())
+
+        # blocks of tied follow-up times; a block's risk set ends at its last row
+        starts = np.r_[0, np.flatnonzero(np.diff(times) != 0) + 1]
+        ends = np.r_[starts[1:], self.n]
+        block_events = np.add.reduceat(observed.astype(int), starts) if self.n else np.zeros(0, int)
+        with_events = block_events > 0
+        self.risk_end = ends[with_events] - 1
+        self.ties = block_events[with_events]
+
+        # each event's tie group and its Efron fraction l / d within that group
+        self.event_rows = np.flatnonzero(observed)
+        block_of_row = np.repeat(np.arange(len(starts)), ends - starts)
+        self.event_group = (np.cumsum(with_events) - 1)[block_of_row[self.event_rows]]
+        group_start = np.r_[0, np.cumsum(self.ties)[:-1]]
+        self.group_start = group_start
+        self.efron_fraction = (np.arange(self.n_events) - group_start[self.event_group]) / self.ties[self.event_group]
+
+    # Values sorted into risk-set order
+    def sort(self, values):
+        return np.asarray(values, dtype=float)[self.order]
+
+    # Partial log-likelihood, score and information at beta for sorted, centred X
+    def derivatives(self, X, beta):
+        eta = X @ beta
+        eta -= eta.max()  # the Efron likelihood is invariant to this shift
+        w = np.exp(eta)
+        wX = w[:, None] * X
+        wXX = wX[:, :, None] * X[:, None, :]
+
+        S0 = np.cumsum(w)[self.risk_end]
+        S1 = np.cumsum(wX, axis=0)[self.risk_end]
+        S2 = np.cumsum(wXX, axis=0)[self.risk_end]
+        E0 = np.add.reduceat(w[self.event_rows], self.group_start)
+        E1 = np.add.reduceat(wX[self.event_rows], self.group_start, axis=0)
+        E2 = np.add.reduceat(wXX[self.event_rows], self.group_start, axis=0)
+
+        k = self.event_group
+        a = self.efron_fraction
+        den = S0[k] - a * E0[k]
+        mean1 = (S1[k] - a[:, None] * E1[k]) / den[:, None]
+        mean2 = (S2[k] - a[:, None, None] * E2[k]) / den[:, None, None]
+
+        loglik = eta[self.event_rows].sum() - np.log(den).sum()
+        score = X[self.event_rows].sum(axis=0) - mean1.sum(axis=0)
+        information = mean2.sum(axis=0) - mean1.T @ mean1
+        return loglik, score, information
+
+    # Newton-Raphson with step halving from beta0; returns estimates and standard errors.
+    # Converged once the Newton step is below `tol` or, as lifelines judges it, once the
+    # log-likelihood changes by less than `r_precision` relative to itself. The latter ends fits
+    # where a covariate's estimate drifts off on a flat likelihood (e.g. a category without
+    # events), which a step-size rule never accepts. r_precision is tighter than lifelines' 1e-9
+    # so that regular fits still end at the maximum.
+    def fit(self, X, beta0, max_iter=50, tol=1e-9, r_precision=1e-12):
+        beta = np.array(beta0, dtype=float)
+        loglik, score, information = self.derivatives(X, beta)
+        for _ in range(max_iter):
+            delta = np.linalg.solve(information, score)
+            step = 1.0
+            while True:
+                candidate = beta + step * delta
+                new_loglik, new_score, new_information = self.derivatives(X, candidate)
+                if np.isfinite(new_loglik) and new_loglik >= loglik - 1e-12 * abs(loglik):
+                    break
+                step /= 2
+                if step < 1e-8:
+                    raise CoxConvergenceError('step halving did not improve the partial likelihood')
+            previous_loglik = loglik
+            beta, loglik, score, information = candidate, new_loglik, new_score, new_information
+            if np.max(np.abs(step * delta), initial=0) < tol:
+                break
+            if previous_loglik != 0 and abs(loglik - previous_loglik) / -previous_loglik < r_precision:
+                break
+        else:
+            raise CoxConvergenceError(f'no convergence after {max_iter} iterations')
+        se = np.sqrt(np.diag(np.linalg.inv(information)))
+        if not np.all(np.isfinite(se)):
+            raise CoxConvergenceError('information matrix is singular')
+        return beta, se
+
+# Cox PH of mortality on attained age ("followup") for every variable, adjusted for covariate_cols.
+# The risk sets are built once and each fit is warm-started from the covariate-only model, or
+# started from zero when that model or the warm-started fit fails.
+# Returns the estimates per variable and a list of the fits that failed both ways.
+def cox_scan(datafile, covariate_cols, variables):
+    followup = datafile['studytime'].to_numpy(dtype=float) + datafile['age'].to_numpy(dtype=float)
+    risk = CoxRiskSets(followup, datafile['mortality'].to_numpy(dtype=float))
+    if risk.n_events == 0:
+        return pd.DataFrame(columns=COX_COLUMNS), [{'Variable': var, 'reason': 'no events'} for var in variables]
+
+    covariates = risk.sort(datafile[covariate_cols].to_numpy(dtype=float)).reshape(risk.n, len(covariate_cols))
+    covariates = covariates - covariates.mean(axis=0)
+    cold_start = np.zeros(covariates.shape[1] + 1)
+    try:
+        beta_start = np.r_[risk.fit(covariates, np.zeros(covariates.shape[1]))[0], 0.0]
+    except (CoxConvergenceError, np.linalg.LinAlgError) as e:
+        logger.info(json.dumps({'event': 'cox_covariate_fit_failed', 'reason': str(e)}))
+        beta_start = cold_start
+
+    rows = []
+    failures = []
+    for var in variables:
+        x = risk.sort(datafile[var].to_numpy(dtype=float))
+        if np.isnan(x).any():
+            failures.append({'Variable': var, 'reason': 'missing values in variable'})
+            continue
+        X = np.column_stack([covariates, x - x.mean()])
+        try:
+            beta, se = risk.fit(X, beta_start)
+        except (CoxConvergenceError, np.linalg.LinAlgError) as e:
+            if beta_start is cold_start:
+                failures.append({'Variable': var, 'reason': str(e)})
+                continue
+            # a warm start can fail where starting from zero does not
+            try:
+                beta, se = risk.fit(X, cold_start)
+            except (CoxConvergenceError, np.linalg.LinAlgError) as e:
+                failures.append({'Variable': var, 'reason': str(e)})
+                continue
+        rows.append((var, beta[-1], se[-1]))
+
+    coef = np.array([row[1] for row in rows], dtype=float)
+    se = np.array([row[2] for row in rows], dtype=float)
+    z_crit = stats.norm.ppf(0.975)
+    frame = pd.DataFrame({
+        'N': risk.n,
+        'Ncases': risk.n_events,
+        'Coefficient': coef,
+        'Std.Error': se,
+        'HR': np.exp(coef),
+        'LL': np.exp(coef - z_crit * se),
+        'UL': np.exp(coef + z_crit * se),
+        'P': 2 * stats.norm.sf(np.abs(coef / se))
+    }, index=pd.Index([row[0] for row in rows], name='Variable'), columns=COX_COLUMNS)
+    return frame, failures
+
+# Model string for one subset/outcome: age is added unless it is the outcome, sex is dropped for one-sex subsets
+def unit_model(model, subs, out):
+    if out not in ["age", "mortality"]:
+        model = f"{model}+age"
+    if "men" in subs:
+        model = model.replace("sex+", "").replace("sex", "")
+    return model
+
+# Column roles of the analysis datasets, built once per run from the metadata header. Raw names
+# are mapped to formula-safe identifiers once and memoized, and metadata columns, dummies of model
+# covariates and tested features are told apart by set lookups instead of prefix/substring scans.
+class ColumnSchema:
+    def __init__(self, metadata_columns):
+        self._clean = {}
+        self.metadata = frozenset(metadata_columns) | frozenset(self.clean(col) for col in metadata_columns)
+
+    # '-' and ' ' become '_', anything else outside [0-9a-zA-Z_] is dropped
+    def clean(self, name):
+        if name not in self._clean:
+            self._clean[name] = re.sub('[^0-9a-zA-Z_]', '', name.replace('-', '_').replace(' ', '_'))
+        return self._clean[name]
+
+    def sanitize(self, datafile):
+        datafile.columns = [self.clean(col) for col in datafile.columns]
+        return datafile
+
+    # Tested features: the feature-frame columns process()/process_precomputed mark in datafile.attrs.
+    # Unmarked datasets fall back to every column that is neither metadata nor a model term dummy.
+    def features(self, datafile, model_terms):
+        marked = datafile.attrs.get('feature_columns')
+        if marked is not None:
+            marked = {self.clean(col) for col in marked}
+            return [col for col in datafile.columns if col in marked]
+        return [
+            col for col in datafile.columns
+            if col not in self.metadata and not any(col.startswith(term + '_') for term in model_terms)
+        ]
+
+    # Encoded columns of the model terms: numeric terms as they are, categorical ones as their dummies
+    def covariates(self, datafile, model_terms):
+        features = set(self.features(datafile, model_terms))
+        columns = []
+        for term in (term.strip() for term in model_terms):
+            if not term:
+                continue
+            if term in datafile.columns:
+                columns.append(term)
+            else:
+                columns.extend(
+                    col for col in datafile.columns
+                    if col.startswith(term + '_') and col not in self.metadata and col not in features
+                )
+        return columns
+
+# Runs every association of one subset/outcome/model and returns its result rows
+def run_unit(datafile, subs, out, model, schema, batched_ols=True, batched_cox=True):
+    model_terms = model.split('+')
+    datafile = schema.sanitize(datafile)
+    variables = schema.features(datafile, model_terms)
+    unit_results = ResultCollector()
+
+    if out != "mortality" and batched_ols:
+        datafile[out] = pd.to_numeric(datafile[out])
+        scan = ols_scan(datafile, out, model, variables)
+        PROFILER.count('ols_fits', len(variables))
+        unit_results.extend(pd.DataFrame({
+            'Datasplit': subs,
+            'Outcome': out,
+            'Variable': scan.index,
+            'Model': model,
+            'N': scan['N'].to_numpy(),
+            'Ncases': np.nan,
+            'Coefficient': scan['Coefficient'].to_numpy(),
+            'Std.Error': scan['Std.Error'].to_numpy(),
+            'HR': np.nan,
+            'LL': scan['LL'].to_numpy(),
+            'UL': scan['UL'].to_numpy(),
+            't.value': scan['t.value'].to_numpy(),
+            'P': scan['P'].to_numpy()
+        }))
+        return unit_results.to_frame()
+
+    if out == "mortality" and batched_cox:
+        scan, failures = cox_scan(datafile, schema.covariates(datafile, model_terms), variables)
+        PROFILER.count('cox_fits', len(variables))
+        PROFILER.count('cox_refits', len(failures))
+        for failure in failures:
+            logger.info(json.dumps({
+                'event': 'cox_fit_refit', 'Datasplit': subs, 'Outcome': out, 'Model': model, **failure
+            }))
+        unit_results.extend(pd.DataFrame({
+            'Datasplit': subs,
+            'Outcome': out,
+            'Variable': scan.index,
+            'Model': model,
+            'N': scan['N'].to_numpy(),
+            'Ncases': scan['Ncases'].to_numpy(),
+            'Coefficient': scan['Coefficient'].to_numpy(),
+            'Std.Error': scan['Std.Error'].to_numpy(),
+            'HR': scan['HR'].to_numpy(),
+            'LL': scan['LL'].to_numpy(),
+            'UL': scan['UL'].to_numpy(),
+            't.value': np.nan,
+            'P': scan['P'].to_numpy()
+        }))
+        if not failures:
+            return unit_results.to_frame()
+        # the batched engine's failures are refitted with lifelines below, which logs the ones it
+        # cannot fit either as cox_fit_failed; rows are then put back in variable order
+        variable_order = {var: i for i, var in enumerate(variables)}
+        variables = [failure['Variable'] for failure in failures]
+    else:
+        variable_order = None
+
+    for var in variables:
+        if out != "mortality":
+            formula = f"{out} ~ {model} + {var}"
+            datafile[out] = pd.to_numeric(datafile[out])
+            y, X = dmatrices(formula, data=datafile, return_type='dataframe')
+            lmmodel = sm.OLS(y, X).fit()
+            PROFILER.count('ols_fits')
+            coefficients = lmmodel.summary2().tables[1]
+            unit_results.add(**{
+                'Datasplit': subs,
+                'Outcome': out,
+                'Variable': var,
+                'Model': model,
+                'N': len(lmmodel.fittedvalues),
+                'Ncases': np.nan,
+                'Coefficient': coefficients.loc[var, 'Coef.'],
+                'Std.Error': coefficients.loc[var, 'Std.Err.'],
+                'HR': np.nan,
+                'LL': coefficients.loc[var, '[0.025'],
+                'UL': coefficients.loc[var, '0.975]'],
+                't.value': coefficients.loc[var, 't'],
+                'P': coefficients.loc[var, 'P>|t|']
+            })
+        else:
+            # attained-age time scale: followup = studytime + age
+            datafile['followup'] = datafile['studytime'] + datafile['age']
+            covariates_use = schema.covariates(datafile, model_terms) + [var]
+            cph = CoxPHFitter()
+            PROFILER.count('cox_fits')
+            try:
+                cph.fit(
+                    datafile[covariates_use + ['followup', 'mortality']],
+                    duration_col='followup',
+                    event_col='mortality'
+                )
+                coefficients = cph.summary
+                unit_results.add(**{
+                    'Datasplit': subs,
+                    'Outcome': out,
+                    'Variable': var,
+                    'Model': model,
+                    'N': cph._n_examples,
+                    'Ncases': cph.event_observed.sum(),
+                    'Coefficient': coefficients.loc[var, 'coef'],
+                    'Std.Error': coefficients.loc[var, 'se(coef)'],
+                    'HR': coefficients.loc[var, 'exp(coef)'],
+                    'LL': coefficients.loc[var, 'exp(coef) lower 95%'],
+                    'UL': coefficients.loc[var, 'exp(coef) upper 95%'],
+                    't.value': np.nan,
+                    'P': coefficients.loc[var, 'p']
+                })
+            except Exception as e:
+                PROFILER.count('cox_failed_fits')
+                logger.info(json.dumps({
+                    'event': 'cox_fit_failed', 'Datasplit': subs, 'Outcome': out, 'Model': model,
+                    'Variable': var, 'covariates': covariates_use, 'error': str(e)
+                }))
+                continue
+
+    if variable_order is None:
+        return unit_results.to_frame()
+    frame = unit_results.to_frame()
+    return frame.iloc[np.argsort(frame['Variable'].map(variable_order).to_numpy(), kind='stable')].reset_index(drop=True)
+
+# Numeric feature frame held in a shared memory block; workers map it instead of receiving pickled copies
+class SharedFrame:
+    def __init__(self, frame):
+        values = np.ascontiguousarray(frame.to_numpy(dtype=np.float64))
+        self.index = frame.index
+        self.columns = frame.columns
+        self.shape = values.shape
+        self._shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        self.name = self._shm.name
+        np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)[:] = values
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        return state
+
+    def frame(self):
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        values = np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)
+        return pd.DataFrame(values, index=self.index, columns=self.columns, copy=False)
+
+    def release(self):
+        self._shm.close()
+        self._shm.unlink()
+
+# Numeric feature frame stored as one float64 .npy block (<path>.npy) plus its row and column
+# labels (<path>.json). The block is opened with mmap_mode='r', so every process reading it shares
+# the page cache rather than holding its own copy; frames opened this way are read-only.
+class MappedFrame:
+    def __init__(self, path):
+        self.path = path
+        self._frame = None
+
+    @classmethod
+    def save(cls, frame, path, fingerprint=None):
+        values = np.ascontiguousarray(frame.to_numpy(dtype=np.float64))
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.npy.tmp', 'wb') as f:
+            np.save(f, values)
+        os.replace(f'{path}.npy.tmp', f'{path}.npy')
+        # the labels file is written last, so its presence marks a complete store
+        with open(f'{path}.json.tmp', 'w') as f:
+            json.dump({
+                'fingerprint': fingerprint,
+                'index_name': frame.index.name,
+                'index': [str(label) for label in frame.index],
+                'columns': [str(label) for label in frame.columns],
+            }, f)
+        os.replace(f'{path}.json.tmp', f'{path}.json')
+        return cls(path)
+
+    # The stored frame, or None when it is missing or was built from other inputs
+    @classmethod
+    def open(cls, path, fingerprint=None):
+        if not os.path.exists(f'{path}.json') or not os.path.exists(f'{path}.npy'):
+            return None
+        with open(f'{path}.json') as f:
+            stored = json.load(f)
+        if fingerprint is not None and stored['fingerprint'] != fingerprint:
+            logger.info(json.dumps({'event': 'feature_store_stale', 'path': path}))
+            return None
+        return cls(path)
+
+    def __getstate__(self):
+        return {'path': self.path, '_frame': None}
+
+    def frame(self):
+        if self._frame is None:
+            with open(f'{self.path}.json') as f:
+                labels = json.load(f)
+            values = np.load(f'{self.path}.npy', mmap_mode='r')
+            self._frame = pd.DataFrame(
+                values,
+                index=pd.Index(labels['index'], name=labels['index_name']),
+                columns=pd.Index(labels['columns']),
+                copy=False
+            )
+        return self._frame
+
+    # nothing to free; the file outlives the run
+    def release(self):
+        pass
+
+_worker_state = {}
+
+def _init_worker(meta, shared, factors, schema, unit_options):
+    _worker_state.update(
+        meta=meta, features=shared.frame(), factors=factors,
+        schema=schema, unit_options=unit_options
+    )
+
+# Returns the unit's results with the profiler records the worker gathered for it
+def _run_shared_unit(unit):
+    subs, out, model = unit
+    model = unit_model(model, subs, out)
+    with PROFILER.stage('dataset', subset=subs, outcome=out, model=model):
+        datafile = process_precomputed(
+            _worker_state['meta'], _worker_state['features'],
+            model=model, sub=subs, out=out, factors=_worker_state['factors']
+        )
+    with PROFILER.stage('associations', subset=subs, outcome=out, model=model):
+        unit_frame = run_unit(datafile, subs, out, model, _worker_state['schema'], **_worker_state['unit_options'])
+    return unit_frame, PROFILER.drain()
+
+# Runs (subset, outcome, model) units on a process pool over a precomputed feature frame.
+# Yields each unit's results in the order of `units`, whatever the number of workers.
+# A MappedFrame is opened by the workers directly; a DataFrame is first put in shared memory.
+# unit_options are passed on to run_unit.
+def run_units_parallel(units, meta, features, factors, schema, workers, **unit_options):
+    shared = features if isinstance(features, MappedFrame) else SharedFrame(features)
+    ctx = multiprocessing.get_context('fork')
+    try:
+        with ctx.Pool(
+            processes=workers,
+            initializer=_init_worker,
+            initargs=(meta, shared, factors, schema, unit_options)
+        ) as pool:
+            for unit_frame, (records, counters) in pool.imap(_run_shared_unit, units):
+                PROFILER.merge(records, counters)
+                yield unit_frame
+    finally:
+        shared.release()
+
+# Fingerprint of a run's inputs (path, size and modification time of each file) and settings
+def run_fingerprint(paths, settings):
+    parts = []
+    for path in paths:
+        stat = os.stat(path)
+        parts.append((os.path.abspath(path), stat.st_size, int(stat.st_mtime)))
+    return hashlib.sha256(repr((parts, settings)).encode()).hexdigest()
+
+# Checkpoint of a long association run. Every finished (subset, outcome, model) unit has its rows
+# written to its own file before it is listed in completed_units.tsv, so after preemption the job
+# can skip finished units. The precomputed feature frame is kept here as well. A checkpoint written
+# for other inputs or settings is cleared.
+class RunCheckpoint:
+    def __init__(self, directory, fingerprint):
+        self.directory = directory
+        self.manifest = os.path.join(directory, 'completed_units.tsv')
+        os.makedirs(directory, exist_ok=True)
+        fingerprint_path = os.path.join(directory, 'fingerprint.txt')
+        previous = open(fingerprint_path).read().strip() if os.path.exists(fingerprint_path) else None
+        if previous != fingerprint:
+            if previous is not None:
+                logger.info(json.dumps({'event': 'checkpoint_reset', 'directory': directory}))
+            for path in glob.glob(os.path.join(directory, 'unit_*.pkl')) + glob.glob(os.path.join(directory, 'features.*')):
+                os.remove(path)
+            if os.path.exists(self.manifest):
+                os.remove(self.manifest)
+            with open(fingerprint_path, 'w') as f:
+                f.write(fingerprint + '\n')
+
+    @staticmethod
+    def unit_id(unit):
+        return hashlib.sha1('\t'.join(unit).encode()).hexdigest()[:16]
+
+    def _unit_path(self, unit):
+        return os.path.join(self.directory, f'unit_{self.unit_id(unit)}.pkl')
+
+    # Ids of the units recorded as finished
+    def completed(self):
+        if not os.path.exists(self.manifest):
+            return set()
+        with open(self.manifest) as f:
+            return {line.split('\t', 1)[0] for line in f if line.strip()}
+
+    def save_unit(self, unit, frame):
+        path = self._unit_path(unit)
+        frame.to_pickle(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        with open(self.manifest, 'a') as f:
+            f.write('\t'.join((self.unit_id(unit),) + tuple(unit)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load_unit(self, unit):
+        return pd.read_pickle(self._unit_path(unit))
+
+    # The feature frame is kept as a MappedFrame, so a resumed run maps it instead of unpickling it
+    def save_features(self, features):
+        return MappedFrame.save(features, os.path.join(self.directory, 'features'))
+
+    def load_features(self):
+        return MappedFrame.open(os.path.join(self.directory, 'features'))
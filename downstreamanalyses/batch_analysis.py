@@ -0,0 +1,135 @@
+import os
+import sys
+import csv
+import time
+import runpy
+import multiprocessing
+from multiprocessing.connection import wait
+import click
+from microbiome_utils import load_taxonomy_index, load_unifrac_stage
+
+# Runs analysiscode.py for many cohort x label combinations from one process. The shared
+# taxonomy and phylogeny are parsed once before forking: every cohort inherits the memoized
+# load_taxonomy_index / load_unifrac_stage results, so build_features gets the parsed TaxonomyIndex
+# and UniFracStage instead of parsing them again (the QIIME2 import is shared the same way).
+# Each manifest row runs in its own forked process with the environment a
+# changenames.sbatch/submit.sbatch job would get, so it writes the same
+# Results_{cohort}_{label}_{date}.csv. Rows are started in manifest order whenever their threads
+# and memory estimate fit in what is still free.
+
+ANALYSIS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analysiscode.py')
+
+# manifest columns that are not passed on as environment variables
+SCHEDULING_COLUMNS = ['memory_gb']
+
+REQUIRED_COLUMNS = ['feature_table', 'metadata', 'modsfile', 'outsfile', 'cohortname', 'subsfile']
+
+def read_manifest(path):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    missing = [col for col in REQUIRED_COLUMNS if rows and col not in rows[0]]
+    if missing:
+        raise ValueError(f"Manifest {path} is missing columns: {', '.join(missing)}")
+    return rows
+
+def cohort_name(row):
+    with open(row['cohortname']) as f:
+        return f.readline().strip()
+
+# Parses every taxonomy and phylogeny the jobs use, so forked cohorts find them in the loaders' caches
+def load_shared_references(jobs):
+    for path in sorted({job['env']['taxonomy'] for job in jobs}):
+        load_taxonomy_index(path)
+    for path in sorted({job['env']['tree'] for job in jobs}):
+        load_unifrac_stage(path).tip_names  # also parses the tree itself
+
+def _run_job(env, log_path):
+    log = open(log_path, 'a')
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+    os.environ.update(env)
+    runpy.run_path(ANALYSIS_SCRIPT, run_name='__main__')
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+# Starts jobs while their threads and memory fit next to the running ones; a job that needs more
+# than the whole budget runs on its own. Returns one status row per job, in manifest order.
+def schedule(jobs, cores, memory_gb, log_dir):
+    ctx = multiprocessing.get_context('fork')
+    pending = list(range(len(jobs)))
+    running = {}
+    statuses = [None] * len(jobs)
+
+    while pending or running:
+        for i in list(pending):
+            job = jobs[i]
+            used_threads = sum(jobs[j]['threads'] for j in running.values())
+            used_memory = sum(jobs[j]['memory_gb'] for j in running.values())
+            fits = used_threads + job['threads'] <= cores and used_memory + job['memory_gb'] <= memory_gb
+            if fits or not running:
+                log_path = os.path.join(log_dir, f"{job['cohort']}_{job['env']['label']}.log")
+                process = ctx.Process(target=_run_job, args=(job['env'], log_path))
+                process.start()
+                running[process.sentinel] = i
+                statuses[i] = {'cohort': job['cohort'], 'label': job['env']['label'], 'log': log_path,
+                               'start': time.time(), 'process': process}
+                pending.remove(i)
+                print(f"started {job['cohort']} ({job['env']['label']})")
+
+        for sentinel in wait(list(running)):
+            i = running.pop(sentinel)
+            status = statuses[i]
+            status['process'].join()
+            status['exitcode'] = status.pop('process').exitcode
+            status['seconds'] = round(time.time() - status.pop('start'), 1)
+            print(f"finished {status['cohort']} ({status['label']}) with exit code {status['exitcode']}")
+
+    return statuses
+
+
+@click.command()
+@click.option('--manifest', type=click.Path(exists=True), required=True,
+              help="TSV with one row per cohort x label. Columns are the changenames.sbatch variables "
+                   "(feature_table, metadata, modsfile, outsfile, cohortname, subsfile, and optionally label, "
+                   "factors, threads, precompute, ...), plus an optional memory_gb estimate.")
+@click.option('--taxonomy', type=click.Path(exists=True), required=True, help="Shared taxonomy artifact.")
+@click.option('--tree', type=click.Path(exists=True), required=True, help="Shared phylogeny artifact.")
+@click.option('--cores', type=int, default=os.cpu_count(), show_default=True, help="Cores shared by all cohorts.")
+@click.option('--memory-gb', type=float, default=64, show_default=True, help="Memory budget shared by all cohorts.")
+@click.option('--threads', type=int, default=6, show_default=True, help="Threads per cohort without a threads column.")
+@click.option('--cohort-memory-gb', type=float, default=32, show_default=True,
+              help="Memory estimate per cohort without a memory_gb column.")
+@click.option('--log-dir', type=click.Path(), default='batchlogs', show_default=True, help="Directory for per-cohort logs.")
+def batch_analysis(manifest, taxonomy, tree, cores, memory_gb, threads, cohort_memory_gb, log_dir):
+    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs('intermediatefiles', exist_ok=True)
+
+    jobs = []
+    for row in read_manifest(manifest):
+        env = {key: value for key, value in row.items() if key not in SCHEDULING_COLUMNS and value not in (None, '')}
+        env.setdefault('taxonomy', taxonomy)
+        env.setdefault('tree', tree)
+        env.setdefault('label', '16s')
+        env.setdefault('threads', str(threads))
+        jobs.append({
+            'env': env,
+            'cohort': cohort_name(row),
+            'threads': int(env['threads']),
+            'memory_gb': float(row.get('memory_gb') or cohort_memory_gb),
+        })
+
+    load_shared_references(jobs)
+    print('loaded shared taxonomy and phylogeny')
+
+    statuses = schedule(jobs, cores, memory_gb, log_dir)
+    with open(os.path.join(log_dir, 'batch_summary.tsv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['cohort', 'label', 'exitcode', 'seconds', 'log'], delimiter='\t')
+        writer.writeheader()
+        writer.writerows(statuses)
+
+    if any(status['exitcode'] != 0 for status in statuses):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    batch_analysis()
@@ -0,0 +1,211 @@
+import os
+import sys
+import csv
+import tempfile
+import traceback
+import multiprocessing
+import click
+import numpy as np
+from sklearn.decomposition import PCA
+
+# Shared helpers live in downstreamanalyses/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from microbiome_utils import (TaxonomyIndex, to_clr, alpha_diversities, min_dissimilarity_blocked,
+                              filter_features_conditionally_native, SubsetIndex, find_complete,
+                              process_precomputed, build_features)
+from association_utils import run_unit, unit_model, ColumnSchema
+from synthetic_cohort import synthetic_cohort, write_cohort
+from profiling_utils import Profiler
+
+# Wall time and peak RSS of each pipeline stage on synthetic cohorts of increasing size.
+# Every stage runs in a forked child whose high-water mark is reset first, so its peak RSS is its
+# own; inputs are built beforehand in the parent and are not part of the timing.
+
+RESULT_FIELDS = ['stage', 'n_samples', 'n_features', 'seconds', 'start_rss_mb', 'peak_rss_mb', 'status']
+
+FACTORS = ['NA']
+OLS_MODEL = 'sex+ppump+metfor+statin+race'
+COX_MODEL = 'sex+ppump+metfor+statin'
+
+# Inputs shared by the stages of one cohort size
+def prepare(cohort):
+    table = cohort['table']
+    taxonomy_index = TaxonomyIndex(cohort['taxonomy'])
+    genus_table = taxonomy_index.collapse(table, 'genus')
+    genus_filtered = filter_features_conditionally_native(genus_table, abundance=0.01, prevalence=0.1)
+    meta = cohort['metadata'].set_index('sampleid')
+    return {
+        'cohort': cohort,
+        'taxonomy_index': taxonomy_index,
+        'genus_table': genus_table,
+        'genus_filtered': genus_filtered,
+        'meta': meta,
+        'subset_index': SubsetIndex(meta),
+        'features': to_clr(genus_filtered).transpose(),
+        'schema': ColumnSchema(cohort['metadata'].columns.str.lower()),
+    }
+
+def stage_collapse_genus(inputs):
+    inputs['taxonomy_index'].collapse(inputs['cohort']['table'], 'genus')
+
+def stage_filter_genus(inputs):
+    filter_features_conditionally_native(inputs['genus_table'], abundance=0.01, prevalence=0.1)
+
+def stage_clr_genus(inputs):
+    to_clr(inputs['genus_filtered'])
+
+def stage_alpha_asv(inputs):
+    alpha_diversities(inputs['cohort']['table'])
+
+def stage_braycurtis_genus(inputs):
+    min_dissimilarity_blocked(inputs['genus_table'], 'braycurtis')
+
+def stage_jaccard_asv(inputs):
+    min_dissimilarity_blocked(inputs['cohort']['table'], 'jaccard')
+
+def stage_find_complete(inputs):
+    for subset in ['all', 'men', 'women', 'age_1', 'age_2', 'age_3', 'age_4', 'age_5']:
+        for out in ['bmi', 'mortality']:
+            find_complete(inputs['meta'], unit_model(OLS_MODEL, subset, out), subset, out, FACTORS)
+
+def stage_find_complete_indexed(inputs):
+    for subset in ['all', 'men', 'women', 'age_1', 'age_2', 'age_3', 'age_4', 'age_5']:
+        for out in ['bmi', 'mortality']:
+            find_complete(inputs['subset_index'], unit_model(OLS_MODEL, subset, out), subset, out, FACTORS)
+
+def _association(inputs, out, model):
+    model = unit_model(model, 'all', out)
+    datafile = process_precomputed(inputs['subset_index'], inputs['features'], model=model, sub='all', out=out, factors=FACTORS)
+    run_unit(datafile, 'all', out, model, inputs['schema'])
+
+def stage_ols_scan(inputs):
+    _association(inputs, 'bmi', OLS_MODEL)
+
+def stage_cox_scan(inputs):
+    _association(inputs, 'mortality', COX_MODEL)
+
+def stage_harmonization_pca(inputs):
+    PCA(n_components=3).fit_transform(to_clr(inputs['genus_table'].transpose()))
+
+# End-to-end feature building from .qza files; needs QIIME2 (and unifrac for the in-memory path)
+def _build_features(inputs, provenance):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_cohort(inputs['cohort'], directory)
+        build_features(paths['taxonomy'], paths['tree'], paths['feature_table'], 1,
+                       list(inputs['meta'].index), label='16s', provenance=provenance)
+
+def stage_build_features(inputs):
+    _build_features(inputs, provenance=True)
+
+def stage_build_features_native(inputs):
+    _build_features(inputs, provenance=False)
+
+STAGES = {
+    'collapse_genus': stage_collapse_genus,
+    'filter_genus': stage_filter_genus,
+    'clr_genus': stage_clr_genus,
+    'alpha_asv': stage_alpha_asv,
+    'braycurtis_genus': stage_braycurtis_genus,
+    'jaccard_asv': stage_jaccard_asv,
+    'find_complete': stage_find_complete,
+    'find_complete_indexed': stage_find_complete_indexed,
+    'ols_scan': stage_ols_scan,
+    'cox_scan': stage_cox_scan,
+    'harmonization_pca': stage_harmonization_pca,
+    'build_features': stage_build_features,
+    'build_features_native': stage_build_features_native,
+}
+DEFAULT_STAGES = [name for name in STAGES if not name.startswith('build_features')]
+
+# A forked child inherits its parent's high-water mark (VmHWM, ru_maxrss). Writing 5 to clear_refs
+# resets it to the current RSS, so VmHWM afterwards is the stage's own peak; where that fails, the
+# peak sampled by a Profiler thread during the stage is used instead
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024  # kB
+    return float('nan')
+
+def _run_stage(stage, inputs, conn):
+    try:
+        profiler = Profiler(enabled=True, interval=0.01)
+        exact_peak = reset_peak_rss()
+        with profiler.stage(stage):
+            STAGES[stage](inputs)
+        record = profiler.records[-1]
+        peak_rss = peak_rss_mb() if exact_peak else record['peak_rss_mb']
+        conn.send((record['seconds'], record['start_rss_mb'], peak_rss, 'ok'))
+    except Exception:
+        conn.send((np.nan, np.nan, np.nan, traceback.format_exc(limit=1).strip().splitlines()[-1]))
+
+# Runs one stage in a forked child; stages that exceed the timeout are killed and reported as such,
+# children that die without a result (e.g. OOM-killed) are reported with their exit code
+def measure(stage, inputs, timeout):
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=_run_stage, args=(stage, inputs, sender))
+    child.start()
+    sender.close()  # only the child holds the sending end, so its death ends the wait
+    try:
+        if receiver.poll(timeout):
+            result = receiver.recv()
+        else:
+            child.kill()
+            result = (np.nan, np.nan, np.nan, f'timeout after {timeout}s')
+    except EOFError:
+        result = None
+    child.join()
+    if result is None:
+        # negative exit codes are signals, e.g. -9 for the OOM killer
+        result = (np.nan, np.nan, np.nan, f'child died with exit code {child.exitcode}')
+    return result
+
+
+@click.command()
+@click.option('--samples', type=int, multiple=True, default=[1000, 5000, 10000, 50000], show_default=True,
+              help="Sample counts to benchmark (repeat the option).")
+@click.option('--features', type=int, multiple=True, default=[2000, 10000], show_default=True,
+              help="Feature counts to benchmark (repeat the option).")
+@click.option('--stages', type=click.Choice(list(STAGES)), multiple=True, default=DEFAULT_STAGES,
+              help="Stages to run; build_features stages need QIIME2 and are off by default.")
+@click.option('--density', type=float, default=0.02, help="Fraction of non-zero table entries.")
+@click.option('--seed', type=int, default=0)
+@click.option('--timeout', type=float, default=3600, help="Seconds before a stage is killed.")
+@click.option('--output', type=click.Path(exists=False), default='benchmark_results.csv', show_default=True,
+              help="CSV the measurements are appended to.")
+def main(samples, features, stages, density, seed, timeout, output):
+    new_file = not os.path.exists(output)
+    with open(output, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if new_file:
+            writer.writeheader()
+        for n_features in features:
+            for n_samples in samples:
+                print(f'preparing {n_samples} samples x {n_features} features')
+                inputs = prepare(synthetic_cohort(n_samples, n_features, density=density, seed=seed))
+                for stage in stages:
+                    seconds, start_rss, peak_rss, status = measure(stage, inputs, timeout)
+                    writer.writerow({
+                        'stage': stage,
+                        'n_samples': n_samples,
+                        'n_features': n_features,
+                        'seconds': round(seconds, 4),
+                        'start_rss_mb': round(start_rss, 1),
+                        'peak_rss_mb': round(peak_rss, 1),
+                        'status': status,
+                    })
+                    f.flush()
+                    print(f'{stage}\t{seconds:.3f}s\t{peak_rss:.0f} MB\t{status}')
+
+
+if __name__ == '__main__':
+    main()
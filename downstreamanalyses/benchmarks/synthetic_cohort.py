@@ -0,0 +1,145 @@
+import os
+import click
+import numpy as np
+import pandas as pd
+import biom
+import skbio
+from scipy import sparse
+
+# Synthetic cohorts shaped like the real inputs of the downstream pipeline: a sparse
+# FeatureTable[Frequency], a Greengenes2-style taxonomy, a rooted tree over the features and
+# metadata with the columns find_complete and the association models use.
+
+# Sparse counts with a long-tailed feature abundance; every sample has at least one read
+def synthetic_table(n_samples, n_features, density=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    weights = rng.pareto(1.2, n_features) + 1e-3
+    weights /= weights.sum()
+
+    nnz = max(int(density * n_samples * n_features), n_samples)
+    rows = np.concatenate([rng.choice(n_features, nnz, p=weights), rng.choice(n_features, n_samples, p=weights)])
+    cols = np.concatenate([rng.integers(0, n_samples, nnz), np.arange(n_samples)])
+    counts = rng.negative_binomial(1, 0.02, len(rows)) + 1
+    matrix = sparse.coo_matrix((counts.astype(np.float64), (rows, cols)), shape=(n_features, n_samples)).tocsr()
+    matrix.sum_duplicates()
+
+    feature_ids = [f'ASV{i:07d}' for i in range(n_features)]
+    sample_ids = [f'S{i:07d}' for i in range(n_samples)]
+    return biom.Table(matrix, feature_ids, sample_ids)
+
+# "d__; p__; c__; o__; f__; g__; s__" strings; some features have no genus or species name
+def synthetic_taxonomy(feature_ids, features_per_genus=8, unknown_genus=0.05, unknown_species=0.3, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(feature_ids)
+    genus = rng.integers(0, max(1, n // features_per_genus), n)
+    species = rng.integers(0, 4, n)
+    no_genus = rng.random(n) < unknown_genus
+    no_species = no_genus | (rng.random(n) < unknown_species)
+
+    taxa = []
+    for g, s, ng, ns in zip(genus, species, no_genus, no_species):
+        ranks = ['d__Bacteria', f'p__Phylum_{g // 1000}', f'c__Class_{g // 300}',
+                 f'o__Order_{g // 100}', f'f__Family_{g // 20}']
+        ranks.append('g__' if ng else f'g__Genus_{g}')
+        ranks.append('s__' if ns else f's__Genus_{g} species_{s}')
+        taxa.append('; '.join(ranks))
+
+    taxonomy = pd.DataFrame({'Taxon': taxa, 'Confidence': 1.0}, index=pd.Index(feature_ids, name='Feature ID'))
+    return taxonomy
+
+# Random rooted binary tree with the features as tips, built by pairing random subtrees
+def synthetic_tree(feature_ids, seed=0):
+    rng = np.random.default_rng(seed)
+    nodes = [f'{tip}:{length:.4f}' for tip, length in zip(feature_ids, rng.exponential(0.05, len(feature_ids)))]
+    while len(nodes) > 1:
+        order = rng.permutation(len(nodes))
+        paired = [f'({nodes[i]},{nodes[j]}):{rng.exponential(0.02):.4f}' for i, j in zip(order[0::2], order[1::2])]
+        if len(order) % 2:
+            paired.append(nodes[order[-1]])
+        nodes = paired
+    return skbio.TreeNode.read([nodes[0].rsplit(':', 1)[0] + ';'])
+
+# Metadata with the columns the pipeline expects; mortality follows an age-dependent hazard
+def synthetic_metadata(sample_ids, missing=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(sample_ids)
+    age = np.round(rng.uniform(16, 90, n), 1)
+    hazard = 0.01 * np.exp(0.06 * (age - 50))
+    death_time = rng.exponential(1 / hazard)
+    censor_time = rng.uniform(2, 15, n)
+
+    meta = pd.DataFrame({
+        'sampleid': sample_ids,
+        'age': age,
+        'sex': rng.choice(['men', 'women'], n),
+        'ppump': rng.binomial(1, 0.15, n),
+        'metfor': rng.binomial(1, 0.08, n),
+        'statin': rng.binomial(1, 0.25, n),
+        'race': rng.choice(['white', 'black', 'asian', 'other'], n, p=[0.7, 0.12, 0.1, 0.08]),
+        'bmi': np.round(rng.normal(26, 4, n), 1),
+        'mortality': (death_time < censor_time).astype(int),
+        'studytime': np.round(np.minimum(death_time, censor_time), 2),
+    })
+    for column in ['bmi', 'ppump', 'race']:
+        meta[column] = meta[column].where(rng.random(n) >= missing)
+    return meta
+
+# In-memory cohort: table, taxonomy, tree and metadata (sample id as a column)
+def synthetic_cohort(n_samples, n_features, density=0.02, seed=0):
+    table = synthetic_table(n_samples, n_features, density=density, seed=seed)
+    feature_ids = list(table.ids(axis='observation'))
+    return {
+        'table': table,
+        'taxonomy': synthetic_taxonomy(feature_ids, seed=seed + 1),
+        'tree': synthetic_tree(feature_ids, seed=seed + 2),
+        'metadata': synthetic_metadata(list(table.ids(axis='sample')), seed=seed + 3),
+    }
+
+# Writes a cohort as the files analysiscode.py reads: .qza artifacts (QIIME2 needed), the
+# metadata TSV and the model, outcome, subset and cohort text files
+def write_cohort(cohort, directory, name='synthetic'):
+    import qiime2
+
+    os.makedirs(directory, exist_ok=True)
+    paths = {
+        'feature_table': os.path.join(directory, 'feature_table.qza'),
+        'taxonomy': os.path.join(directory, 'taxonomy.qza'),
+        'tree': os.path.join(directory, 'tree.qza'),
+        'metadata': os.path.join(directory, 'metadata.tsv'),
+        'modsfile': os.path.join(directory, 'models.txt'),
+        'outsfile': os.path.join(directory, 'outs.txt'),
+        'subsfile': os.path.join(directory, 'subsets.txt'),
+        'cohortname': os.path.join(directory, 'cohort.txt'),
+    }
+    qiime2.Artifact.import_data('FeatureTable[Frequency]', cohort['table']).save(paths['feature_table'])
+    qiime2.Artifact.import_data('FeatureData[Taxonomy]', cohort['taxonomy']).save(paths['taxonomy'])
+    qiime2.Artifact.import_data('Phylogeny[Rooted]', cohort['tree']).save(paths['tree'])
+    cohort['metadata'].to_csv(paths['metadata'], sep='\t', index=False)
+
+    text_files = {
+        'modsfile': ['sex', 'sex+ppump+metfor+statin+race'],
+        'outsfile': ['bmi', 'mortality'],
+        'subsfile': ['all', 'men', 'women', 'age_3'],
+        'cohortname': [name],
+    }
+    for key, lines in text_files.items():
+        with open(paths[key], 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    return paths
+
+
+@click.command()
+@click.option('--samples', type=int, required=True, help="Number of samples.")
+@click.option('--features', type=int, required=True, help="Number of features (ASVs / OGUs).")
+@click.option('--density', type=float, default=0.02, help="Fraction of non-zero table entries.")
+@click.option('--seed', type=int, default=0)
+@click.option('--name', default='synthetic', help="Cohort name written to cohort.txt.")
+@click.option('--output-dir', type=click.Path(exists=False), required=True, help="Directory to save the cohort files.")
+def main(samples, features, density, seed, name, output_dir):
+    cohort = synthetic_cohort(samples, features, density=density, seed=seed)
+    for key, path in write_cohort(cohort, output_dir, name=name).items():
+        print(f'{key}\t{path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,37 @@
+import os
+import sys
 import click
 import qiime2
 import pandas as pd
 import numpy as np
-from skbio.stats.composition import clr
 from sklearn.decomposition import PCA
 import matplotlib.pyplot as plt
 import seaborn as sns
 import biom
 
-# Function to aggregate data at the genus level using taxonomy
-def as_genus(table, taxonomy):
-    taxonomy['genus'] = taxonomy['Taxon'].apply(lambda x: x.split('; ')[-2])
-    genus_map = taxonomy['genus'].to_dict()
-    return table.collapse(lambda i, m: genus_map.get(i, 'Unknown'), norm=False, axis='observation')
+# Shared helpers live in downstreamanalyses/microbiome_utils.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from microbiome_utils import TaxonomyIndex, to_clr, read_biom_totals
+from harmonization_state import HarmonizationState, common_genus_table
 
-# Function to calculate centered log-ratio (CLR) transformation
-def to_clr(df):
-    df += 1  # Add pseudocount
-    df = df.div(df.sum(axis=0), axis=1)  # Convert to relative abundance
-    return pd.DataFrame(clr(df.T), columns=df.index, index=df.columns).T
+# Function to aggregate data at the genus level using the parsed taxonomy
+def as_genus(table, taxonomy_index):
+    return taxonomy_index.collapse(table, 'genus', unknown='Unknown')
+
+# Total counts per genus of a cohort, in order of first appearance as in as_genus; the
+# streaming mode sums the feature table straight from the file instead of loading it
+def genus_totals(table, taxonomy_index, streaming=False):
+    if streaming:
+        totals = read_biom_totals(table)
+        labels = taxonomy_index.labels(totals.index, 'genus', unknown='Unknown')
+        return totals.groupby(labels, sort=False).sum()
+    return pd.Series(table.sum(axis="observation"), index=table.ids(axis="observation"))
+
+# Function to calculate centered log-ratio (CLR) transformation of samples x genera.
+# Each genus is normalized across samples, as the shared loadings were fitted with, which is
+# the sparse CLR of microbiome_utils applied to the transposed genus table.
+def genus_clr(genus_table):
+    return to_clr(genus_table.transpose())
 
 # Function to perform PCA
 def perform_pca(data, n_components=3):
@@ -32,20 +45,27 @@ def perform_pca(data, n_components=3):
 @click.option('--cohort-names', multiple=True, required=True, help="Names of cohorts corresponding to the tables.")
 @click.option('--output-dir', type=click.Path(exists=False), required=True, help="Directory to save outputs.")
 @click.option('--top-n', type=int, default=5, help="Number of top genera to filter.")
-def get_loadings(taxonomy, tables, cohort_names, output_dir, top_n):
+@click.option('--streaming', is_flag=True, default=False,
+              help="Two passes over the tables (genus totals, then only the selected genera), holding one cohort at a time instead of all tables.")
+@click.option('--state', type=click.Path(exists=False), default=None,
+              help="Also save the combined CLR statistics here (.npz), so harmonization_state.py can fold in new cohorts without refitting.")
+def get_loadings(taxonomy, tables, cohort_names, output_dir, top_n, streaming, state):
     if len(tables) != len(cohort_names):
         raise ValueError("Number of tables must match the number of cohort names.")
     
-    # Load taxonomy
-    taxonomy_df = qiime2.Artifact.load(taxonomy).view(pd.DataFrame)
+    # Load taxonomy and parse it once for all cohorts
+    taxonomy_index = TaxonomyIndex(qiime2.Artifact.load(taxonomy).view(pd.DataFrame))
     
-    # Load and process BIOM tables
-    biom_tables = [qiime2.Artifact.load(tbl).view(biom.Table) for tbl in tables]
-    genus_tables = [as_genus(tbl, taxonomy_df) for tbl in biom_tables]
+    # Load and process BIOM tables; when streaming, only the paths are kept until the second pass
+    if streaming:
+        genus_tables = list(tables)
+    else:
+        biom_tables = [qiime2.Artifact.load(tbl).view(biom.Table) for tbl in tables]
+        genus_tables = [as_genus(tbl, taxonomy_index) for tbl in biom_tables]
 
     # Identify common top genera
     top_genera_per_cohort = [
-        set(pd.Series(table.sum(axis="observation"), index=table.ids(axis="observation"))
+        set(genus_totals(table, taxonomy_index, streaming)
             .sort_values(ascending=False)
             .head(top_n)
             .index.tolist())
@@ -63,14 +83,22 @@ def get_loadings(taxonomy, tables, cohort_names, output_dir, top_n):
     combined_clr_data = []
 
     for table, cohort_name in zip(genus_tables, cohort_names):
-        genus_table_filtered = table.filter(common_top_genera, axis='observation').to_dataframe()
-        clr_data = to_clr(genus_table_filtered.T)
+        if streaming:
+            genus_table_filtered = common_genus_table(table, taxonomy_index, common_top_genera)
+        else:
+            genus_table_filtered = table.filter(common_top_genera, axis='observation', inplace=False)
+        clr_data = genus_clr(genus_table_filtered)
         clr_data["Cohort"] = cohort_name
         cohort_labels.extend([cohort_name] * clr_data.shape[0])
         combined_clr_data.append(clr_data.drop(columns=["Cohort"]))
 
     # Combine all CLR-transformed data
     combined_clr_data = pd.concat(combined_clr_data, axis=0)
+    if state:
+        harmonization_state = HarmonizationState(combined_clr_data.columns)
+        for cohort_name in cohort_names:
+            harmonization_state.fold(cohort_name, combined_clr_data[np.asarray(cohort_labels) == cohort_name])
+        harmonization_state.save(state)
     cohort_labels = pd.Series(cohort_labels, index=combined_clr_data.index, name="Cohort")
 
     # Perform PCA on combined data
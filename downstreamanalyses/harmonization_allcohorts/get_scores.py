@@ -1,8 +1,12 @@
+import os
+import sys
 import pandas as pd
 import numpy as np
-from skbio.stats.composition import clr
 import qiime2
-import biom
+
+# Shared helpers live in downstreamanalyses/microbiome_utils.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from microbiome_utils import TaxonomyIndex, to_clr, read_biom_subset
 
 #Change file paths if not in current directory; add cohort name
 cohort_name = '' #Type cohort name if the cohort has both 16S and shotgun make either cohortA16S or cohortAshotgun
@@ -14,38 +18,34 @@ common_genera_path = 'common_genera.txt' #Type the path to the file with the 7 g
 
 ####### Keep everything underneath this line untouched ########
 
-# Function to calculate centered log-ratio (CLR) transformation
-def to_clr(df):
-    df += 1  # Add pseudocount
-    df = df.div(df.sum(axis=0), axis=1)  # Convert to relative abundance
-    return pd.DataFrame(clr(df.T), columns=df.index, index=df.columns).T
+# Function to calculate centered log-ratio (CLR) transformation of samples x genera.
+# Each genus is normalized across samples, as the shared loadings were fitted with, which is
+# the sparse CLR of microbiome_utils applied to the transposed genus table.
+def genus_clr(genus_table):
+    return to_clr(genus_table.transpose())
 
 # Function to compute PCA scores using predefined loadings
 def apply_loadings(new_data, loadings):
     return new_data.dot(loadings)
 
-#On genus level
-def as_genus(table, taxonomy):
-    taxonomy['genus'] = taxonomy['Taxon'].apply(lambda x: x.split('; ')[-2])
-    genus_map = taxonomy['genus'].to_dict()
-    return table.collapse(lambda i, m: genus_map.get(i, 'Unknown'), norm=False, axis='observation')
+#On genus level, collapsing only the features of the given genera
+def as_genus(table, taxonomy_index, genera):
+    return taxonomy_index.collapse(table, 'genus', unknown='Unknown', groups=genera)
 
 # Load loadings for PCA
 loadings = pd.read_csv(pca_loadings_path, index_col=0)
 
-# Load taxonomy and featuretable QIIME 2 artifacts
+# Load taxonomy QIIME 2 artifact
 taxonomy_artifact = qiime2.Artifact.load(taxonomy_path)
-taxonomy_df = taxonomy_artifact.view(pd.DataFrame)
-
-feature_table_artifact =qiime2.Artifact.load(feature_table_path).view(biom.Table)
-feature_table = as_genus(feature_table_artifact, taxonomy_df)
+taxonomy_index = TaxonomyIndex(taxonomy_artifact.view(pd.DataFrame))
 
-# Filter the table for common genera
+# Read only the features of the common genera from the feature table and collapse them
 common_top_genera = pd.read_csv(common_genera_path, header=None).squeeze("columns").tolist()
-genus_table_filtered = feature_table.filter(common_top_genera, axis='observation').to_dataframe()
+feature_table_artifact = read_biom_subset(feature_table_path, observation_ids=taxonomy_index.members(common_top_genera))
+genus_table_filtered = as_genus(feature_table_artifact, taxonomy_index, common_top_genera)
 
 # Perform CLR transformation
-clr_data = to_clr(genus_table_filtered.T)
+clr_data = genus_clr(genus_table_filtered)
 
 # Apply loadings to compute scores
 scores = apply_loadings(clr_data, loadings)
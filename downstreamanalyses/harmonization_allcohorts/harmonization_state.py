@@ -0,0 +1,143 @@
+import os
+import sys
+import click
+import qiime2
+import pandas as pd
+import numpy as np
+import biom
+
+# Shared helpers live in downstreamanalyses/microbiome_utils.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from microbiome_utils import TaxonomyIndex, to_clr, read_biom_subset
+
+# Incremental harmonization PCA. Instead of refitting sklearn PCA on the CLR data of all cohorts
+# whenever one is added, the state keeps the sample count, mean and scatter matrix of the combined
+# CLR data (samples x common genera). New cohorts are folded in with the pairwise update of Chan
+# et al., and the loadings are the leading eigenvectors of the resulting covariance, which are the
+# components sklearn PCA finds on the pooled data (up to sign).
+
+# Genus counts of only the common genera (features of other genera are never collapsed).
+# `table` is a biom.Table or the path of a FeatureTable .qza, of which only those features are read.
+def common_genus_table(table, taxonomy_index, genera):
+    if not isinstance(table, biom.Table):
+        table = read_biom_subset(table, observation_ids=taxonomy_index.members(genera))
+    return taxonomy_index.collapse(table, 'genus', unknown='Unknown', groups=genera)
+
+# CLR of samples x genera, each genus normalized across the samples of its cohort as the shared
+# loadings were fitted with; only the genera themselves are needed for that
+def genus_clr(genus_table):
+    return to_clr(genus_table.transpose())
+
+class HarmonizationState:
+    def __init__(self, genera):
+        self.genera = list(genera)
+        self.cohorts = {}  # cohort name -> number of samples folded in
+        self.n = 0
+        self.mean = np.zeros(len(self.genera))
+        self.scatter = np.zeros((len(self.genera), len(self.genera)))
+
+    # Adds the samples x genera CLR data of one cohort to the combined statistics
+    def fold(self, cohort_name, clr_data):
+        if cohort_name in self.cohorts:
+            raise ValueError(f"Cohort {cohort_name} is already part of the harmonization state")
+        missing = [genus for genus in self.genera if genus not in clr_data.columns]
+        if missing:
+            raise ValueError(f"Cohort {cohort_name} lacks common genera: {', '.join(missing)}")
+        values = clr_data[self.genera].to_numpy(dtype=np.float64)
+        n_new = values.shape[0]
+        if n_new == 0:
+            raise ValueError(f"Cohort {cohort_name} has no samples")
+        mean_new = values.mean(axis=0)
+        centered = values - mean_new
+        delta = mean_new - self.mean
+        n = self.n + n_new
+        self.scatter += centered.T @ centered + np.outer(delta, delta) * self.n * n_new / n
+        self.mean += delta * n_new / n
+        self.n = n
+        self.cohorts[cohort_name] = n_new
+
+    def covariance(self):
+        return self.scatter / (self.n - 1)
+
+    # Loadings (genera x PCs) and explained variance ratios. Each component is signed so its
+    # largest loading is positive, or, with `reference` loadings, so it points the same way as
+    # the matching reference component, keeping PCs comparable across folds.
+    def pca(self, n_components=3, reference=None):
+        covariance = self.covariance()
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:n_components]
+        components = eigenvectors[:, order]
+        if reference is not None:
+            signs = np.sign(np.einsum('ij,ij->j', components, reference.loc[self.genera].to_numpy()[:, :n_components]))
+        else:
+            signs = np.sign(components[np.abs(components).argmax(axis=0), np.arange(components.shape[1])])
+        components = components * np.where(signs == 0, 1, signs)
+        columns = [f"PC{j+1}" for j in range(n_components)]
+        loadings = pd.DataFrame(components, index=self.genera, columns=columns)
+        explained_variance = pd.Series(eigenvalues[order] / np.trace(covariance), index=columns)
+        return loadings, explained_variance
+
+    # Scores of samples x genera CLR data; centered on the combined mean as PCA.transform does,
+    # or uncentered as get_scores.py applies the shared loadings
+    def scores(self, clr_data, loadings, center=True):
+        values = clr_data[self.genera].to_numpy(dtype=np.float64)
+        if center:
+            values = values - self.mean
+        return pd.DataFrame(values @ loadings.loc[self.genera].to_numpy(), index=clr_data.index, columns=loadings.columns)
+
+    def save(self, path):
+        np.savez(path, genera=np.array(self.genera, dtype=str), cohorts=np.array(list(self.cohorts), dtype=str),
+                 cohort_sizes=np.array(list(self.cohorts.values()), dtype=np.int64),
+                 n=self.n, mean=self.mean, scatter=self.scatter)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as stored:
+            state = cls(stored['genera'].tolist())
+            state.cohorts = dict(zip(stored['cohorts'].tolist(), stored['cohort_sizes'].tolist()))
+            state.n = int(stored['n'])
+            state.mean = stored['mean']
+            state.scatter = stored['scatter']
+        return state
+
+
+@click.command()
+@click.option('--state', type=click.Path(exists=True), required=True, help="Harmonization state (.npz) written by create_loadings_top_genera.py --state.")
+@click.option('--taxonomy', type=click.Path(exists=True), required=True, help="Path to the taxonomy file.")
+@click.option('--tables', type=click.Path(exists=True), multiple=True, required=True, help="Paths to qza feature tables of the new cohorts.")
+@click.option('--cohort-names', multiple=True, required=True, help="Names of the new cohorts corresponding to the tables.")
+@click.option('--output-dir', type=click.Path(exists=False), required=True, help="Directory to save outputs.")
+@click.option('--n-components', type=int, default=3, help="Number of principal components.")
+def fold_cohorts(state, taxonomy, tables, cohort_names, output_dir, n_components):
+    if len(tables) != len(cohort_names):
+        raise ValueError("Number of tables must match the number of cohort names.")
+
+    state_path = state
+    state = HarmonizationState.load(state_path)
+    taxonomy_index = TaxonomyIndex(qiime2.Artifact.load(taxonomy).view(pd.DataFrame))
+
+    loadings_path = f"{output_dir}/combined_pca_loadings.csv"
+    reference = pd.read_csv(loadings_path, index_col=0) if os.path.exists(loadings_path) else None
+
+    clr_per_cohort = {}
+    for table, cohort_name in zip(tables, cohort_names):
+        genus_table = common_genus_table(table, taxonomy_index, state.genera)
+        clr_per_cohort[cohort_name] = genus_clr(genus_table)
+        state.fold(cohort_name, clr_per_cohort[cohort_name])
+
+    loadings, explained_variance = state.pca(n_components, reference=reference)
+    loadings.to_csv(loadings_path, index=True)
+    explained_variance.to_csv(f"{output_dir}/explained_variance.csv")
+    state.save(state_path)
+
+    # scores of the new cohorts only; the other cohorts' data are not needed for the update
+    for cohort_name, clr_data in clr_per_cohort.items():
+        scores = state.scores(clr_data, loadings)
+        scores["Cohort"] = cohort_name
+        scores.to_csv(f"{output_dir}/pca_scores_{cohort_name}.csv", index=True)
+
+    print(f"Folded {', '.join(cohort_names)} into {state.n} samples from {len(state.cohorts)} cohorts.")
+    print("Explained variance by each principal component:", explained_variance.to_numpy())
+
+if __name__ == '__main__':
+    fold_cohorts()
@@ -1,17 +1,32 @@
+import os
+import re
+import shutil
+import zipfile
+import tempfile
+import contextlib
+import functools
+import hashlib
+import pickle
 import click
 import qiime2
 from qiime2.plugins import diversity
 import pandas as pd
 import numpy as np
-from skbio.stats.composition import clr
 import skbio
 import biom
+import h5py
 import csv
 from skbio import DistanceMatrix
+from scipy import sparse
+from scipy.spatial.distance import cdist, pdist, squareform
 from qiime2.plugins.feature_table.methods import filter_features_conditionally
+from profiling_utils import PROFILER
 
 # Select non-missing cases
 def find_complete(metadata, model, subset, out, factors):
+    if isinstance(metadata, SubsetIndex):
+        return metadata.find_complete(model, subset, out, factors)
+
     if isinstance(out, str):
         out = [out]
 
@@ -72,29 +87,589 @@ def find_complete(metadata, model, subset, out, factors):
 
     return final_df
 
+# Metadata with the find_complete selections precomputed: a row mask per subset, a
+# non-missing mask per column and categorical codes per factor, all built once and combined
+# per model with vector operations. find_complete(index, ...) gives the same frame as
+# find_complete(metadata, ...).
+class SubsetIndex:
+    age_ranges = {
+        'age_1': (18, 40),
+        'age_2': (40, 50),
+        'age_3': (50, 60),
+        'age_4': (60, 70),
+        'age_5': (70, float('inf'))
+    }
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        age = metadata['age'].to_numpy(dtype=np.float64, na_value=np.nan)
+        adult = age >= 18
+        self.subsets = {'all': adult}
+        if 'sex' in metadata.columns:
+            sex = metadata['sex'].to_numpy(dtype=object)
+            for name in ['men', 'women']:
+                self.subsets[name] = adult & (sex == name)
+        for name, (age_min, age_max) in self.age_ranges.items():
+            self.subsets[name] = adult & (age >= age_min) & (age < age_max)
+        self._present = {}
+        self._codes = {}
+        self._categoricals = {}
+
+    @property
+    def index(self):
+        return self.metadata.index
+
+    def present(self, column):
+        if column not in self._present:
+            self._present[column] = self.metadata[column].notna().to_numpy()
+        return self._present[column]
+
+    # pd.factorize codes over the whole column, missing values are -1
+    def codes(self, column):
+        if column not in self._codes:
+            self._codes[column] = pd.factorize(self.metadata[column])
+        return self._codes[column]
+
+    # whole-column categorical for fixed category lists (sex and the 0/1 factors)
+    def fixed_categorical(self, column, categories):
+        key = (column, tuple(categories))
+        if key not in self._categoricals:
+            self._categoricals[key] = pd.Categorical(self.metadata[column], categories=categories, ordered=True)
+        return self._categoricals[key]
+
+    # categories in order of first appearance among the selected rows, with the chosen one first
+    def ranked_categorical(self, column, rows, kind):
+        codes, uniques = self.codes(column)
+        selected = codes[rows]
+        present = selected[selected >= 0]
+        _, first = np.unique(present, return_index=True)
+        order = present[np.sort(first)]
+        if kind == 'race':
+            white = np.flatnonzero(uniques == 'white')
+            order = order[order != white[0]] if len(white) else order
+            categories = ['white'] + list(uniques[order])
+        else:
+            # value_counts on the codes breaks ties the same way as on the values
+            largest = pd.Series(present).value_counts().idxmax()
+            order = np.concatenate([[largest], order[order != largest]])
+            categories = list(uniques[order])
+        lookup = np.full(len(uniques) + 1, -1)
+        offset = 1 if kind == 'race' else 0
+        lookup[order] = np.arange(len(order)) + offset
+        if kind == 'race' and len(white):
+            lookup[white[0]] = 0
+        return pd.Categorical.from_codes(lookup[selected], categories=categories, ordered=True)
+
+    def find_complete(self, model, subset, out, factors):
+        if isinstance(out, str):
+            out = [out]
+
+        columns = model.split('+') if model else []
+        all_columns = columns + out
+
+        if out == ['mortality']:
+            all_columns += ['studytime', 'age']
+
+        if subset not in self.subsets:
+            raise ValueError(f"Invalid subset: {subset}")
+        mask = self.subsets[subset].copy()
+        for column in all_columns:
+            mask &= self.present(column)
+        rows = np.flatnonzero(mask)
+
+        base_factors = ['ppump', 'metfor', 'statin', 'race']
+        factor_names = base_factors + factors if factors != ['NA'] else base_factors
+        if subset not in ['women', 'men']:
+            factor_names = ['sex'] + factor_names
+
+        converted = {}
+        for factor_name in factor_names:
+            if factor_name == 'sex':
+                converted['sex'] = self.fixed_categorical('sex', ['men', 'women'])[rows]
+            elif factor_name == 'race':
+                converted['race'] = self.ranked_categorical('race', rows, 'race')
+            elif factor_name in factors:
+                converted[factor_name] = self.ranked_categorical(factor_name, rows, 'largest')
+            else:
+                converted[factor_name] = self.fixed_categorical(factor_name, [0, 1])[rows]
+
+        final_df = self.metadata.iloc[rows].copy(deep=False)  # rows were already taken into new arrays
+        for factor_name, values in converted.items():
+            final_df[factor_name] = values
+
+        if 'mortality' in out:
+            for covariate in columns:
+                if final_df[covariate].dtype == 'object' or final_df[covariate].dtype.name == 'category':
+                    final_df = pd.get_dummies(final_df, columns=[covariate], drop_first=True)
+
+        return final_df
+
+# Greengenes2 taxonomy parsed once into integer group codes per rank. collapse() sums the
+# features of each group with one sparse matrix product instead of biom's per-observation callback.
+class TaxonomyIndex:
+    ranks = {'genus': -2, 'species': -1}
+
+    # uuid identifies the source artifact in cache keys; None for an index built from a plain frame
+    def __init__(self, taxonomy, uuid=None):
+        self.uuid = uuid
+        self.feature_ids = pd.Index(taxonomy.index.astype(str))
+        levels = taxonomy['Taxon'].str.split('; ')
+        self.codes = {}
+        self.names = {}
+        for rank, position in self.ranks.items():
+            codes, names = pd.factorize(levels.str[position])
+            self.codes[rank] = codes
+            self.names[rank] = np.asarray(names, dtype=object)
+
+    # Group label of each feature id; features without a (parsable) taxon get `unknown`
+    def labels(self, feature_ids, rank='genus', unknown='Unknown_Genus_{}'):
+        feature_ids = pd.Index(feature_ids).astype(str)
+        positions = self.feature_ids.get_indexer(feature_ids)
+        codes = np.where(positions >= 0, self.codes[rank][positions], -1)
+        labels = np.empty(len(feature_ids), dtype=object)
+        labels[codes >= 0] = self.names[rank][codes[codes >= 0]]
+        for i in np.flatnonzero(codes < 0):
+            labels[i] = unknown.format(feature_ids[i])
+        return labels
+
+    # Feature ids that belong to any of the groups, in taxonomy order
+    def members(self, groups, rank='genus'):
+        wanted = np.flatnonzero(pd.Index(self.names[rank]).isin(list(groups)))
+        return self.feature_ids[np.isin(self.codes[rank], wanted)]
+
+    # Same counts and group order (first appearance) as table.collapse(..., norm=False, axis='observation').
+    # With `groups`, only features of those groups are summed, giving the collapsed table already
+    # filtered to them (groups that are absent are left out).
+    def collapse(self, table, rank='genus', unknown='Unknown_Genus_{}', groups=None):
+        labels = self.labels(table.ids(axis='observation'), rank, unknown)
+        matrix = table.matrix_data
+        if groups is not None:
+            keep = np.flatnonzero(pd.Index(labels).isin(list(groups)))
+            labels, matrix = labels[keep], matrix.tocsr()[keep]
+        groups, group_ids = pd.factorize(labels)
+        indicator = sparse.csr_matrix(
+            (np.ones(len(groups)), (groups, np.arange(len(groups)))),
+            shape=(len(group_ids), len(groups))
+        )
+        data = indicator @ matrix.tocsc().astype(np.float64)
+        return biom.Table(data, observation_ids=list(group_ids), sample_ids=table.ids(axis='sample'))
+
+# Parses each taxonomy artifact once per process
+@functools.lru_cache(maxsize=4)
+def load_taxonomy_index(taxonomy_path):
+    taxonomy_ar = qiime2.Artifact.load(taxonomy_path)
+    return TaxonomyIndex(taxonomy_ar.view(pd.DataFrame), uuid=taxonomy_ar.uuid)
+
 def as_genus(table, taxonomy):
+    if isinstance(taxonomy, TaxonomyIndex):
+        return taxonomy.collapse(table, 'genus', unknown='Unknown_Genus_{}')
     genus = taxonomy['genus'].to_dict()
     return table.collapse(lambda i, m: genus.get(i, f'Unknown_Genus_{i}'), norm=False, axis='observation')
 
-def to_clr(data):
-    df = data.to_dataframe()
-    df += 1
-    df = df.div(df.sum(axis=0), axis=1)
-    return pd.DataFrame(clr(df.T), columns=df.index, index=df.columns).T
+# CLR of every sample (column) after a pseudocount of 1, returned as features x samples.
+# Works from the sparse counts: log(x + 1) keeps zeros as zeros and closure cancels out of the CLR,
+# so only one chunk of samples is made dense at a time, directly into the output.
+def to_clr(data, dtype=np.float64, chunk_size=2048):
+    counts = data.matrix_data.tocsc()
+    n_features, n_samples = counts.shape
+    clr_values = np.empty((n_samples, n_features), dtype=dtype)
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        logs = counts[:, start:stop].astype(np.float64).log1p()
+        means = np.asarray(logs.sum(axis=0)).ravel() / n_features
+        clr_values[start:stop] = logs.T.toarray() - means[:, None]
+    return pd.DataFrame(clr_values, index=data.ids(axis='sample'), columns=data.ids(axis='observation')).T
+
+# Accepts an artifact or an in-memory table
+def as_biom_table(table):
+    return table if isinstance(table, biom.Table) else table.view(biom.Table)
+
+# The BIOM HDF5 file of a FeatureTable .qza (or a .biom file itself), opened with h5py. A stored
+# member is read in place; a compressed one is first unpacked to a temporary file, since
+# seeking in a deflated zip member restarts decompression.
+@contextlib.contextmanager
+def open_biom_hdf5(path):
+    if not zipfile.is_zipfile(path):
+        with h5py.File(path, 'r') as f:
+            yield f
+        return
+    with zipfile.ZipFile(path) as archive:
+        member = next((info for info in archive.infolist() if info.filename.endswith('/data/feature-table.biom')), None)
+        if member is None:
+            raise ValueError(f"{path} does not contain a BIOM feature table")
+        if member.compress_type == zipfile.ZIP_STORED:
+            with archive.open(member) as raw, h5py.File(raw, 'r') as f:
+                yield f
+            return
+        with tempfile.NamedTemporaryFile(suffix='.biom') as unpacked:
+            with archive.open(member) as raw:
+                shutil.copyfileobj(raw, unpacked, 16 * 1024 ** 2)
+            unpacked.flush()
+            with h5py.File(unpacked.name, 'r') as f:
+                yield f
+
+# Rows of one axis ('observation' or 'sample') of an open BIOM file, from its compressed
+# (CSR for observations, CSC for samples) layout: only indptr and the data of the kept rows are
+# read, with adjacent rows fetched in one slice. Ids not in the file are skipped; the kept ones
+# stay in file order.
+def _read_biom_axis(f, axis, ids):
+    axis_ids = pd.Index(f[f'{axis}/ids'].asstr()[:])
+    positions = np.sort(axis_ids.get_indexer(pd.Index(ids).astype(str).unique()))
+    positions = positions[positions >= 0]
+    indptr = f[f'{axis}/matrix/indptr'][:]
+    starts, ends = indptr[positions], indptr[positions + 1]
+
+    # runs of rows whose data are contiguous on disk
+    breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    run_starts = starts[np.r_[0, breaks]] if len(positions) else []
+    run_ends = ends[np.r_[breaks - 1, len(positions) - 1]] if len(positions) else []
+    data = [f[f'{axis}/matrix/data'][start:end] for start, end in zip(run_starts, run_ends)]
+    indices = [f[f'{axis}/matrix/indices'][start:end] for start, end in zip(run_starts, run_ends)]
+
+    row_indptr = np.r_[0, np.cumsum(ends - starts)]
+    other = 'sample' if axis == 'observation' else 'observation'
+    n_other = f[f'{other}/ids'].shape[0]
+    matrix = sparse.csr_matrix(
+        (np.concatenate(data) if data else np.empty(0), np.concatenate(indices) if indices else np.empty(0, dtype=np.int32), row_indptr),
+        shape=(len(positions), n_other)
+    )
+    return matrix, list(axis_ids[positions])
+
+# Sum of every observation (or sample) of a FeatureTable .qza or .biom file, in table order.
+# The nonzero values are read in blocks of about `block_size`, so the table is never held whole.
+def read_biom_totals(path, axis='observation', block_size=16 * 1024 ** 2):
+    with open_biom_hdf5(path) as f:
+        ids = f[f'{axis}/ids'].asstr()[:]
+        indptr = f[f'{axis}/matrix/indptr'][:]
+        data = f[f'{axis}/matrix/data']
+        totals = np.zeros(len(ids))
+        row = 0
+        while row < len(ids):
+            # whole rows per block, at least one
+            stop = max(int(np.searchsorted(indptr, indptr[row] + block_size, side='right')) - 1, row + 1)
+            stop = min(stop, len(ids))
+            values = data[indptr[row]:indptr[stop]]
+            rows = np.repeat(np.arange(stop - row), np.diff(indptr[row:stop + 1]))
+            totals[row:stop] = np.bincount(rows, weights=values, minlength=stop - row)
+            row = stop
+    return pd.Series(totals, index=ids)
+
+# biom.Table with only the requested observations and/or samples of a FeatureTable .qza or .biom
+# file, read straight from the HDF5 layout without loading the whole table (or QIIME2).
+# Requested ids missing from the table are left out; kept ids are in table order.
+def read_biom_subset(path, observation_ids=None, sample_ids=None):
+    with open_biom_hdf5(path) as f:
+        if observation_ids is None and sample_ids is None:
+            return biom.Table.from_hdf5(f)
+        if observation_ids is not None:
+            matrix, obs_ids = _read_biom_axis(f, 'observation', observation_ids)
+            samp_ids = list(f['sample/ids'].asstr()[:])
+        else:
+            matrix, samp_ids = _read_biom_axis(f, 'sample', sample_ids)
+            matrix = matrix.T
+            obs_ids = list(f['observation/ids'].asstr()[:])
+    table = biom.Table(matrix, obs_ids, samp_ids)
+    if observation_ids is not None and sample_ids is not None:
+        keep = set(pd.Index(sample_ids).astype(str))
+        table = table.filter(lambda values, id_, md: id_ in keep, axis='sample', inplace=False)
+    return table
 
 def calculate_min_dissimilarity(distance_matrix):
-    temp_df = distance_matrix.view(DistanceMatrix)
+    temp_df = distance_matrix if isinstance(distance_matrix, DistanceMatrix) else distance_matrix.view(DistanceMatrix)
     dm_df = temp_df.to_data_frame()
     dm_matrix = dm_df.values
     np.fill_diagonal(dm_matrix, np.nan)
-    return np.nanmin(dm_matrix, axis=1)
+    return pd.Series(np.nanmin(dm_matrix, axis=1), index=dm_df.index)
+
+# Nearest-neighbour Bray-Curtis or Jaccard dissimilarity per sample, same values as
+# calculate_min_dissimilarity on diversity.actions.beta, but computed in row tiles that only
+# keep the running minima, so the N x N distance matrix is never held in memory.
+# Jaccard is on presence/absence, as in q2-diversity.
+def min_dissimilarity_blocked(table, metric, max_block_bytes=256 * 1024 ** 2):
+    counts = table.matrix_data.T.tocsr().astype(np.float64)  # samples x features
+    n_samples, n_features = counts.shape
+    minima = np.full(n_samples, np.nan)
+    if n_samples < 2:
+        return pd.Series(minima, index=table.ids(axis='sample'))
+
+    if metric == 'jaccard':
+        presence = (counts > 0).astype(np.float64)
+        richness = np.asarray(presence.sum(axis=1)).ravel()
+        rows_per_block = max(1, max_block_bytes // (8 * n_samples))
+        for start in range(0, n_samples, rows_per_block):
+            stop = min(start + rows_per_block, n_samples)
+            shared = (presence[start:stop] @ presence.T).toarray()
+            union = richness[start:stop, None] + richness[None, :] - shared
+            with np.errstate(divide='ignore', invalid='ignore'):
+                tile = np.where(union > 0, 1 - shared / union, 0.0)
+            tile[np.arange(stop - start), np.arange(start, stop)] = np.inf  # skip self-distances
+            minima[start:stop] = tile.min(axis=1)
+
+    elif metric == 'braycurtis':
+        # two dense row blocks plus their tile of distances; each tile serves both of its blocks, so
+        # only pairs j >= i are computed, and dense blocks are kept while they fit in the budget, so
+        # small and medium tables are densified once
+        rows_per_block = max(1, min(int(np.sqrt(max_block_bytes / 8)), max_block_bytes // (8 * 2 * max(n_features, 1))))
+        starts = list(range(0, n_samples, rows_per_block))
+        dense_blocks = {}
+        dense_bytes = 0
+
+        def dense_block(i):
+            nonlocal dense_bytes
+            if i in dense_blocks:
+                return dense_blocks[i]
+            block = counts[starts[i]:starts[i] + rows_per_block].toarray()
+            if dense_bytes + block.nbytes <= max_block_bytes:
+                dense_blocks[i] = block
+                dense_bytes += block.nbytes
+            return block
+
+        running = np.full(n_samples, np.inf)
+        for i, start in enumerate(starts):
+            block = dense_block(i)
+            stop = start + block.shape[0]
+            for j in range(i, len(starts)):
+                other_start = starts[j]
+                if j == i:
+                    other = block
+                    tile = squareform(pdist(block, metric='braycurtis'))
+                    np.fill_diagonal(tile, np.inf)
+                else:
+                    other = dense_block(j)
+                    tile = cdist(block, other, metric='braycurtis')
+                tile[np.isnan(tile)] = np.inf
+                running[start:stop] = np.minimum(running[start:stop], tile.min(axis=1))
+                other_stop = other_start + other.shape[0]
+                running[other_start:other_stop] = np.minimum(running[other_start:other_stop], tile.min(axis=0))
+        minima = running
+
+    else:
+        raise ValueError(f"Blocked nearest-neighbour dissimilarity is not available for {metric}")
+
+    minima = np.where(np.isinf(minima), np.nan, minima)
+    return pd.Series(minima, index=table.ids(axis='sample'))
+
+# In-memory counterpart of q2-feature-table's filter_features_conditionally: keeps the features with
+# a relative abundance of at least `abundance` in at least a `prevalence` fraction of the samples
+def filter_features_conditionally_native(table, abundance, prevalence):
+    counts = table.matrix_data.tocsc()
+    totals = np.asarray(counts.sum(axis=0)).ravel().astype(np.float64)
+    scale = np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0)
+    relative = (counts @ sparse.diags(scale)).tocsr()
+    hits = np.asarray((relative >= abundance).sum(axis=1)).ravel()
+    keep = table.ids(axis='observation')[hits >= prevalence * table.shape[1]]
+    return table.filter(keep, axis='observation', inplace=False)
+
+# Tree preparation shared by all UniFrac metrics: the phylogeny is read once, sheared to the
+# table's features once, and that sheared tree is used for both unweighted and weighted normalized
+# UniFrac. Artifact tables go through beta_phylogenetic with the sheared tree imported once as a
+# Phylogeny[Rooted] artifact; biom.Tables go straight to the unifrac library.
+class UniFracStage:
+    metrics = ('unweighted_unifrac', 'weighted_normalized_unifrac')
+
+    def __init__(self, tree_ar, threads=1):
+        self.tree_ar = tree_ar
+        self.uuid = tree_ar.uuid
+        self.threads = threads
+        self._tree = None
+        self._tip_names = None
+        self._sheared = (None, None)
+        self._sheared_ar = (None, None)
+
+    # The phylogeny as a bp (balanced parentheses) tree parsed from the newick file, which takes a
+    # fraction of the memory and time of an skbio.TreeNode for trees the size of Greengenes2;
+    # without bp installed it falls back to the TreeNode
+    @property
+    def tree(self):
+        if self._tree is None:
+            try:
+                import bp
+            except ImportError:
+                self._tree = self.tree_ar.view(skbio.TreeNode)
+            else:
+                from q2_types.tree import NewickFormat
+                with open(str(self.tree_ar.view(NewickFormat))) as newick:
+                    self._tree = bp.parse_newick(newick.read())
+        return self._tree
+
+    @property
+    def tip_names(self):
+        if self._tip_names is None:
+            tree = self.tree
+            if isinstance(tree, skbio.TreeNode):
+                self._tip_names = frozenset(tip.name for tip in tree.tips())
+            else:
+                # a tip is an opening parenthesis directly followed by its closing one
+                parentheses = np.asarray(tree.B, dtype=bool)
+                tips = np.flatnonzero(parentheses[:-1] & ~parentheses[1:])
+                self._tip_names = frozenset(tree.name(i) for i in tips.tolist())
+        return self._tip_names
+
+    # only the last sheared tree is kept; models of one run share their feature set
+    def shear(self, feature_ids):
+        names = frozenset(feature_ids) & self.tip_names
+        if self._sheared[0] != names:
+            self._sheared = (names, self.tree.shear(set(names)))
+        return self._sheared[1]
+
+    # The sheared tree as an artifact for beta_phylogenetic, imported once per feature set
+    def sheared_artifact(self, feature_ids):
+        tree = self.shear(feature_ids)
+        names = self._sheared[0]
+        if self._sheared_ar[0] != names:
+            if isinstance(tree, skbio.TreeNode):
+                tree_ar = qiime2.Artifact.import_data('Phylogeny[Rooted]', tree)
+            else:
+                import bp
+                with tempfile.TemporaryDirectory() as tmp:
+                    path = os.path.join(tmp, 'tree.nwk')
+                    with open(path, 'w') as newick:
+                        bp.write_newick(tree, newick, True)
+                    tree_ar = qiime2.Artifact.import_data('Phylogeny[Rooted]', path)
+            self._sheared_ar = (names, tree_ar)
+        return self._sheared_ar[1]
+
+    def distance_matrices(self, table, metrics=metrics, threads=None):
+        threads = threads or self.threads
+        if isinstance(table, biom.Table):
+            import unifrac
+            methods = {
+                'unweighted_unifrac': unifrac.unweighted,
+                'weighted_normalized_unifrac': unifrac.weighted_normalized,
+            }
+            tree = self.shear(table.ids(axis='observation'))
+            return {metric: methods[metric](table, tree, threads=threads) for metric in metrics}
+        tree_ar = self.sheared_artifact(as_biom_table(table).ids(axis='observation'))
+        return {
+            metric: diversity.actions.beta_phylogenetic(table, tree_ar, threads=threads, metric=metric).distance_matrix
+            for metric in metrics
+        }
+
+    def min_dissimilarities(self, table, threads=None):
+        return {metric: calculate_min_dissimilarity(dm) for metric, dm in self.distance_matrices(table, threads=threads).items()}
+
+# One stage per phylogeny file and process; the thread count is given per call
+@functools.lru_cache(maxsize=2)
+def load_unifrac_stage(tree_path):
+    return UniFracStage(qiime2.Artifact.load(tree_path))
 
 def add_alpha_diversity_to_metadata(metadata_df, diversity_metric, column_name):
-    alpha_df = diversity_metric.view(pd.Series)
+    alpha_df = diversity_metric.view(pd.Series) if isinstance(diversity_metric, qiime2.Artifact) else diversity_metric
     metadata_df[column_name] = metadata_df.index.map(alpha_df)
     return metadata_df
 
-def process_beta_diversities(table_ar, genus_table_ar, species_table_ar, tree_ar, threads, metadata):
+# The alpha definitions follow the installed scikit-bio, as diversity.actions.alpha does
+SKBIO_VERSION = tuple(int(v) for v in re.findall(r'\d+', skbio.__version__)[:3])
+
+# scikit-bio before 0.6 (as in QIIME2 2023.7) divides Simpson's evenness by the number of features
+# in the table, absent ones included; later versions divide by the observed features
+SIMPSON_E_OVER_ALL_FEATURES = SKBIO_VERSION < (0, 6)
+
+# Shannon's log base: 2 up to scikit-bio 0.6.0 (QIIME2 2023.7), e from 0.6.1 on
+SHANNON_BASE = 2 if SKBIO_VERSION < (0, 6, 1) else np.e
+
+# Shannon, Chao1 (bias-corrected), Simpson and Simpson's evenness of every sample from one sweep
+# over the sparse counts, with the definitions diversity.actions.alpha uses
+def alpha_diversities(table):
+    counts = table.matrix_data.tocsc().astype(np.float64)
+    counts.eliminate_zeros()
+    n_features, n_samples = counts.shape
+    sample_of = np.repeat(np.arange(n_samples), np.diff(counts.indptr))
+    values = counts.data
+
+    totals = np.bincount(sample_of, weights=values, minlength=n_samples)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = values / totals[sample_of]
+        observed = np.bincount(sample_of, minlength=n_samples).astype(np.float64)
+        singles = np.bincount(sample_of, weights=values == 1, minlength=n_samples)
+        doubles = np.bincount(sample_of, weights=values == 2, minlength=n_samples)
+        dominance = np.bincount(sample_of, weights=p ** 2, minlength=n_samples)
+        shannon = 0.0 - np.bincount(sample_of, weights=p * np.log(p), minlength=n_samples) / np.log(SHANNON_BASE)  # no -0.0 for one-feature samples
+        evenness_size = n_features if SIMPSON_E_OVER_ALL_FEATURES else observed
+        alpha = pd.DataFrame({
+            'shannon': shannon,
+            'chao1': observed + singles * (singles - 1) / (2 * (doubles + 1)),
+            'simpson': 1 - dominance,
+            'simpson_e': 1 / dominance / evenness_size
+        }, index=table.ids(axis='sample'))
+
+    # empty samples have no defined diversity except their Chao1 of 0
+    empty = totals == 0
+    alpha.loc[empty, ['shannon', 'simpson', 'simpson_e']] = np.nan
+    return alpha
+
+# On-disk cache of per-sample diversity vectors (alpha values and nearest-neighbour dissimilarities).
+# Entries are addressed by a hash of what they were computed from; when the cache grows past
+# max_bytes the least recently used entries are removed.
+class DiversityCache:
+    version = 1
+
+    def __init__(self, directory, max_bytes=5 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr((self.version,) + tuple(key)).encode()).hexdigest()
+        return os.path.join(self.directory, f'{digest}.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            value = pd.read_pickle(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(path)  # marks the entry as recently used
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        value.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    # Processes sharing the directory evict concurrently, so entries may vanish while this runs
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+# Identity of a diversity computation's inputs: source artifact UUIDs and settings that change the
+# computed values (provenance), plus the exact sample set
+def diversity_cache_key(sample_ids, **inputs):
+    samples = hashlib.sha256('\n'.join(sorted(map(str, sample_ids))).encode()).hexdigest()
+    return tuple(sorted((name, str(value)) for name, value in inputs.items())) + (('samples', samples),)
+
+# Looks a diversity vector up in the cache, computing and storing it on a miss
+def cached_diversity(cache, cache_key, level, metric, compute):
+    with PROFILER.stage('diversity', level=level, metric=metric):
+        if cache is None or cache_key is None:
+            return compute()
+        key = cache_key + (('level', level), ('metric', metric))
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            cache.put(key, value)
+        else:
+            PROFILER.count('diversity_cache_hits')
+        return value
+
+def process_beta_diversities(table_ar, genus_table_ar, species_table_ar, tree_ar, threads, metadata, cache=None, cache_key=None, streaming=True):
     beta_metrics = {
         'braycurtis': ['min_bray_asv', 'min_bray_genus'],
         'jaccard': ['min_jacc_asv', 'min_jacc_genus']
@@ -105,35 +680,49 @@ def process_beta_diversities(table_ar, genus_table_ar, species_table_ar, tree_ar
         beta_metrics['braycurtis'].append('min_bray_species')
         beta_metrics['jaccard'].append('min_jacc_species')
 
+    # streaming keeps only the running minima instead of materializing the distance matrix
+    def min_beta(table, metric):
+        if streaming or isinstance(table, biom.Table):
+            return min_dissimilarity_blocked(as_biom_table(table), metric)
+        return calculate_min_dissimilarity(diversity.actions.beta(table, metric=metric).distance_matrix)
+
     for metric, columns in beta_metrics.items():
         print(metric)
 
         # ASV-level (only if applicable, i.e., not None)
         if columns[0] is not None:
-            dm_asv = diversity.actions.beta(table_ar, metric=metric).distance_matrix
-            metadata[columns[0]] = calculate_min_dissimilarity(dm_asv)
+            metadata[columns[0]] = cached_diversity(cache, cache_key, 'asv', metric,
+                                                    lambda: min_beta(table_ar, metric))
 
         # Genus-level
-        dm_genus = diversity.actions.beta(genus_table_ar, metric=metric).distance_matrix
-        metadata[columns[1]] = calculate_min_dissimilarity(dm_genus)
+        metadata[columns[1]] = cached_diversity(cache, cache_key, 'genus', metric,
+                                                lambda: min_beta(genus_table_ar, metric))
 
         # Species-level (if defined)
         if species_table_ar is not None and len(columns) > 2:
-            dm_species = diversity.actions.beta(species_table_ar, metric=metric).distance_matrix
-            metadata[columns[2]] = calculate_min_dissimilarity(dm_species)
+            metadata[columns[2]] = cached_diversity(cache, cache_key, 'species', metric,
+                                                    lambda: min_beta(species_table_ar, metric))
+
+    # both UniFrac metrics come from one stage sharing the sheared tree
+    unifrac_stage = tree_ar if isinstance(tree_ar, UniFracStage) else UniFracStage(tree_ar, threads)
+    unifrac_values = {}
 
+    def min_unifrac(metric):
+        if not unifrac_values:
+            unifrac_values.update(unifrac_stage.min_dissimilarities(table_ar, threads=threads))
+        return unifrac_values[metric]
 
     print('uu')
-    dm_uu = diversity.actions.beta_phylogenetic(table_ar, tree_ar, threads=threads, metric='unweighted_unifrac').distance_matrix
-    metadata['min_uu_feature'] = calculate_min_dissimilarity(dm_uu)
+    metadata['min_uu_feature'] = cached_diversity(cache, cache_key, 'asv', 'unweighted_unifrac',
+                                                  lambda: min_unifrac('unweighted_unifrac'))
 
     print('wu')
-    dm_wu = diversity.actions.beta_phylogenetic(table_ar, tree_ar, threads=threads, metric='weighted_normalized_unifrac').distance_matrix
-    metadata['min_wu_feature'] = calculate_min_dissimilarity(dm_wu)
+    metadata['min_wu_feature'] = cached_diversity(cache, cache_key, 'asv', 'weighted_normalized_unifrac',
+                                                  lambda: min_unifrac('weighted_normalized_unifrac'))
 
     return metadata
 
-def process_alpha_diversities(table_ar, genus_table_ar, species_table_ar, tree_ar, threads, metadata):
+def process_alpha_diversities(table_ar, genus_table_ar, species_table_ar, tree_ar, threads, metadata, cache=None, cache_key=None, fused=True):
     all_metrics = {
         'asv': (table_ar, 'asv'),
         'genus': (genus_table_ar, 'genus')
@@ -144,12 +733,22 @@ def process_alpha_diversities(table_ar, genus_table_ar, species_table_ar, tree_a
 
     metric_names = ['shannon', 'chao1', 'simpson', 'simpson_e']
 
+    # fused computes all metrics of a table from one pass over its counts instead of one QIIME2 action each
+    fused_values = {}
+
     def process_metric(method, table, tree, metric, column_name, metadata):
-        if method == 'alpha_phylogenetic':
-            dm = getattr(diversity.actions, method)(table, tree, metric=metric)
-        else:
-            dm = getattr(diversity.actions, method)(table, metric=metric)
-        return add_alpha_diversity_to_metadata(metadata, dm.alpha_diversity, column_name)
+        def compute():
+            if (fused or isinstance(table, biom.Table)) and method == 'alpha':
+                if table_label not in fused_values:
+                    fused_values[table_label] = alpha_diversities(as_biom_table(table))
+                return fused_values[table_label][metric]
+            if method == 'alpha_phylogenetic':
+                dm = getattr(diversity.actions, method)(table, tree, metric=metric)
+            else:
+                dm = getattr(diversity.actions, method)(table, metric=metric)
+            return dm.alpha_diversity.view(pd.Series)
+        alpha = cached_diversity(cache, cache_key, table_label, metric, compute)
+        return add_alpha_diversity_to_metadata(metadata, alpha, column_name)
 
     for table_label, (table, suffix) in all_metrics.items():
         for metric in metric_names:
@@ -161,75 +760,158 @@ def process_alpha_diversities(table_ar, genus_table_ar, species_table_ar, tree_a
 
     return metadata
 
-def process(taxonomy, tree, feature_table, output, threads, metadata, model, sub, out, factors, label='16s'):
+# Lower-cased metadata column names, from the header line only
+@functools.lru_cache(maxsize=4)
+def metadata_columns(metadata):
+    return pd.read_csv(metadata, sep='\t', nrows=0).columns.str.lower()
+
+# Metadata columns find_complete touches for these models, outcomes and study factors
+def required_metadata_columns(models, outcomes, factors):
+    columns = ['sampleid', 'age', 'sex', 'ppump', 'metfor', 'statin', 'race']
+    columns += [factor for factor in factors if factor != 'NA']
+    for model in models:
+        columns += model.split('+') if model else []
+    for out in outcomes:
+        columns += [out] if isinstance(out, str) else list(out)
+        if out == 'mortality' or out == ['mortality']:
+            columns += ['studytime']
+    return tuple(dict.fromkeys(column.lower() for column in columns))
+
+# Text columns are parsed as strings up front, the rest keep pandas' numeric inference
+METADATA_DTYPES = {'sampleid': str, 'sex': str, 'race': str}
+
+# Parsed metadata indexed by sample id. With columns, only those (matched case-insensitively)
+# are read. Frames are memoized per file and column set, so callers must not modify them.
+@functools.lru_cache(maxsize=8)
+def _read_metadata(metadata, columns):
+    wanted = None if columns is None else set(columns)
+    usecols = None if wanted is None else (lambda col: col.lower() in wanted)
+    dtypes = {col: METADATA_DTYPES[col.lower()] for col in pd.read_csv(metadata, sep='\t', nrows=0).columns
+              if col.lower() in METADATA_DTYPES}
     try:
-        meta = pd.read_csv(metadata, sep='\t')
+        meta = pd.read_csv(metadata, sep='\t', usecols=usecols, dtype=dtypes)
         meta.columns = [col.lower() for col in meta.columns]
         meta['sampleid'] = meta['sampleid'].astype(str)
         meta = meta.set_index('sampleid')
     except csv.Error as e:
         raise ValueError(f"Error parsing metadata file: {e}")
+    return meta
+
+def read_metadata(metadata, columns=None):
+    return _read_metadata(metadata, None if columns is None else tuple(sorted(set(columns) | {'sampleid'})))
+
+# Participants any subset can draw from (see find_complete)
+def eligible_samples(meta):
+    if isinstance(meta, SubsetIndex):
+        return meta.index[meta.subsets['all']].tolist()
+    return meta.index[meta['age'] >= 18].tolist()
+
+# Diversity and CLR columns for the given samples, indexed by sample id.
+# With provenance=False the tables stay in memory as biom.Tables between stages and the native
+# filter and diversity implementations are used; no intermediate artifacts are written.
+def build_features(taxonomy, tree, feature_table, threads, sample_ids, label='16s', cache=None, provenance=True):
+    with PROFILER.stage('load_artifacts'):
+        taxonomy_index = taxonomy if isinstance(taxonomy, TaxonomyIndex) else load_taxonomy_index(taxonomy)
+        unifrac_stage = tree if isinstance(tree, UniFracStage) else load_unifrac_stage(tree)
+        ftable_ar = qiime2.Artifact.load(feature_table)
+        feature_table = ftable_ar.view(biom.Table)
+
+    with PROFILER.stage('filter_samples'):
+        valid_sample_ids = set(feature_table.ids(axis='sample'))
+        common_sample_ids = [sid for sid in sample_ids if sid in valid_sample_ids]
+        filtered_table_sample = feature_table.filter(common_sample_ids, axis='sample', inplace=False)
+    # without a taxonomy artifact UUID the inputs cannot be identified, so nothing is cached
+    cache_key = None
+    if taxonomy_index.uuid is not None:
+        cache_key = diversity_cache_key(
+            filtered_table_sample.ids(axis='sample'),
+            feature_table=ftable_ar.uuid, taxonomy=taxonomy_index.uuid, tree=unifrac_stage.uuid,
+            provenance=provenance
+        )
 
-    meta_df = find_complete(meta, model, sub, out, factors)
-    taxonomy = qiime2.Artifact.load(taxonomy).view(pd.DataFrame)
-    tree_ar = qiime2.Artifact.load(tree)
-    sample_ids = meta_df.index.tolist()
-
-    ftable_ar = qiime2.Artifact.load(feature_table)
-    feature_table = ftable_ar.view(biom.Table)
-    valid_sample_ids = set(feature_table.ids(axis='sample'))
-    common_sample_ids = [sid for sid in sample_ids if sid in valid_sample_ids]
-    meta_df = meta_df.loc[common_sample_ids]
-    filtered_table_sample = feature_table.filter(common_sample_ids, axis='sample', inplace=False)
-    filtered_sample_ar = qiime2.Artifact.import_data('FeatureTable[Frequency]', filtered_table_sample)
-
-    taxonomy['genus'] = taxonomy['Taxon'].apply(lambda x: x.split('; ')[-2])
-    genus_table_tax = as_genus(filtered_table_sample, taxonomy)
-    genus_table_ar_unfiltered = qiime2.Artifact.import_data('FeatureTable[Frequency]', genus_table_tax)
-    genus_table_ar = filter_features_conditionally(genus_table_ar_unfiltered, abundance=0.01, prevalence=0.1).filtered_table
-    genus_table = genus_table_ar.view(biom.Table)
-    genus_table_clr = to_clr(genus_table)
+    def as_input(table):
+        return qiime2.Artifact.import_data('FeatureTable[Frequency]', table) if provenance else table
+
+    def filter_conditionally(table):
+        if provenance:
+            return filter_features_conditionally(table, abundance=0.01, prevalence=0.1).filtered_table.view(biom.Table)
+        return filter_features_conditionally_native(table, abundance=0.01, prevalence=0.1)
+
+    filtered_sample_ar = as_input(filtered_table_sample)
 
+    with PROFILER.stage('collapse', level='genus'):
+        genus_table_tax = as_genus(filtered_table_sample, taxonomy_index)
+        genus_table_ar_unfiltered = as_input(genus_table_tax)
+    with PROFILER.stage('filter_features', level='genus'):
+        genus_table = filter_conditionally(genus_table_ar_unfiltered if provenance else genus_table_tax)
+    with PROFILER.stage('clr', level='genus'):
+        genus_table_clr = to_clr(genus_table)
+
+    species_table = None
     species_table_ar_unfiltered = None
     if label.lower() != '16s':
         print('Calculating species-level metrics...')
-        taxonomy['species'] = taxonomy['Taxon'].apply(lambda x: x.split('; ')[-1])
-        species_table_tax = filtered_table_sample.collapse(
-            lambda i, m: taxonomy['species'].get(i, f'Unknown_Species_{i}'),
-            norm=False,
-            axis='observation'
-        )
-        species_table_ar_unfiltered = qiime2.Artifact.import_data('FeatureTable[Frequency]', species_table_tax)
-        species_table_ar = filter_features_conditionally(species_table_ar_unfiltered, abundance=0.01, prevalence=0.1).filtered_table
+        with PROFILER.stage('collapse', level='species'):
+            species_table_tax = taxonomy_index.collapse(filtered_table_sample, 'species', unknown='Unknown_Species_{}')
+            species_table_ar_unfiltered = as_input(species_table_tax)
+        with PROFILER.stage('filter_features', level='species'):
+            species_table = filter_conditionally(species_table_ar_unfiltered if provenance else species_table_tax)
 
-    meta_df = process_beta_diversities(
+    # Diversity vectors come back in the table's sample order
+    features = pd.DataFrame(index=filtered_table_sample.ids(axis='sample'))
+
+    features = process_beta_diversities(
         filtered_sample_ar,
         genus_table_ar_unfiltered,
         species_table_ar_unfiltered,
-        tree_ar,
+        unifrac_stage,
         threads,
-        meta_df
+        features,
+        cache=cache,
+        cache_key=cache_key
     )
 
-    meta_df = process_alpha_diversities(
+    features = process_alpha_diversities(
         filtered_sample_ar,
         genus_table_ar_unfiltered,
         species_table_ar_unfiltered,
-        tree_ar,
+        unifrac_stage,
         threads,
-        meta_df
+        features,
+        cache=cache,
+        cache_key=cache_key
     )
 
     genustable_join = genus_table_clr.transpose()
-    newfile = meta_df.join(genustable_join)
+    features = features.join(genustable_join)
 
-    if species_table_ar is not None:
-        species_table = species_table_ar.view(biom.Table)
-        species_table_clr = to_clr(species_table)
+    if species_table is not None:
+        with PROFILER.stage('clr', level='species'):
+            species_table_clr = to_clr(species_table)
         species_table_join = species_table_clr.transpose()
-        newfile = newfile.join(species_table_join)
+        features = features.join(species_table_join)
 
-    return newfile
+    return features
+
+# Analysis dataset for one subset/outcome/model from features built once for all eligible samples
+def process_precomputed(meta, features, model, sub, out, factors):
+    meta_df = find_complete(meta, model, sub, out, factors)
+    datafile = meta_df.join(features, how='inner')
+    datafile.attrs['feature_columns'] = list(features.columns)  # tells the tested features from metadata and dummies
+    return datafile
+
+def process(taxonomy, tree, feature_table, output, threads, metadata, model, sub, out, factors, label='16s', cache=None, provenance=True):
+    meta = read_metadata(metadata, columns=required_metadata_columns([model], [out], factors))
+    meta_df = find_complete(meta, model, sub, out, factors)
+    features = build_features(taxonomy, tree, feature_table, threads, meta_df.index.tolist(), label=label, cache=cache,
+                              provenance=provenance)
+    datafile = meta_df.join(features, how='inner')
+    datafile.attrs['feature_columns'] = list(features.columns)  # tells the tested features from metadata and dummies
+    return datafile
+
+# Reads yes/no switches passed in through sbatch --export
+def env_flag(name, default='no'):
+    return os.getenv(name, default).strip("'").lower() in ('yes', 'true', '1')
 
 
 if __name__ == '__main__':
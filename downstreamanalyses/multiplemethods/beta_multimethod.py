@@ -1,10 +1,15 @@
+import os
+import sys
 import click
 import qiime2
 from qiime2.plugins import diversity, emperor
 import pandas as pd
-import skbio
 import biom
 
+# Shared helpers live in downstreamanalyses/microbiome_utils.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from microbiome_utils import UniFracStage  # reads the phylogeny once and shares its sheared tree
+
 def concat(table_16s, table_wgs, metadata):
     md_ids = set(metadata.index)
     overlap = (set(table_16s.ids()) & set(table_wgs.ids()) & md_ids)
@@ -28,9 +33,8 @@ def concat(table_16s, table_wgs, metadata):
     return table, md
 
 
-def filter_table(table, tree, depth=None):
-    feats = {n.name for n in tree.tips()}
-    table = table.filter(feats & set(table.ids(axis='observation')), axis='observation')
+def filter_table(table, tip_names, depth=None):
+    table = table.filter(tip_names & set(table.ids(axis='observation')), axis='observation')
     if depth is not None:
         table = table.filter(lambda v, i, m: v.sum() >= depth).remove_empty()
     return table
@@ -50,16 +54,15 @@ def filter_table(table, tree, depth=None):
 def beta_multimeth(taxonomy, tree, table_16s, table_wgs, output, threads, metadata,
             depth_16s, depth_wgs):
     taxonomy = qiime2.Artifact.load(taxonomy).view(pd.DataFrame)
-    tree_ar = qiime2.Artifact.load(tree)
-    tree = tree_ar.view(skbio.TreeNode)
+    unifrac_stage = UniFracStage(qiime2.Artifact.load(tree), threads)
     table_16s_ar = qiime2.Artifact.load(table_16s)
     table_wgs_ar = qiime2.Artifact.load(table_wgs)
     table_16s = table_16s_ar.view(biom.Table)
     table_wgs = table_wgs_ar.view(biom.Table)
     metadata = qiime2.Metadata.load(metadata).to_dataframe()
 
-    table_16s = filter_table(table_16s, tree, depth_16s)
-    table_wgs = filter_table(table_wgs, tree, depth_wgs)
+    table_16s = filter_table(table_16s, unifrac_stage.tip_names, depth_16s)
+    table_wgs = filter_table(table_wgs, unifrac_stage.tip_names, depth_wgs)
     table, metadata = concat(table_16s, table_wgs, metadata)
 
     metadata.to_csv(output + '.metadata.tsv', sep='\t', index=True, header=True)
@@ -68,9 +71,8 @@ def beta_multimeth(taxonomy, tree, table_16s, table_wgs, output, threads, metada
     table_ar.save(output + '.feature_table.qza')
 
     
-    wu_feature_dm, = diversity.actions.beta_phylogenetic(table_ar, tree_ar,
-                                                         threads=threads,
-                                                         metric='weighted_normalized_unifrac')
+    # UniFrac runs on the tree sheared to the concatenated table's features, imported once
+    wu_feature_dm = unifrac_stage.distance_matrices(table_ar, metrics=['weighted_normalized_unifrac'])['weighted_normalized_unifrac']
     wu_feature_pc, = diversity.actions.pcoa(wu_feature_dm, number_of_dimensions=5)
     wu_feature_emp, = emperor.actions.plot(wu_feature_pc, qiime2.Metadata(metadata))
     wu_feature_dm.save(output + '.asv.weighted.qza')
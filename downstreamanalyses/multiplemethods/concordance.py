@@ -0,0 +1,107 @@
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata, spearmanr
+
+# Rank concordance between two aligned matrices (e.g. 16S and WGS genus tables, samples x genera).
+# Both matrices are ranked once along the requested axis and every correlation is a Pearson
+# correlation on those ranks, computed for all columns (axis=0) or rows (axis=1) at once.
+# Ties get average ranks, as in scipy.stats.spearmanr.
+
+# Pearson correlation of matching columns; NaN where either column is constant
+def _columnwise_pearson(a, b):
+    a = a - a.mean(axis=-2, keepdims=True)
+    b = b - b.mean(axis=-2, keepdims=True)
+    sab = np.einsum('...ij,...ij->...j', a, b)
+    saa = np.einsum('...ij,...ij->...j', a, a)
+    sbb = np.einsum('...ij,...ij->...j', b, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = sab / np.sqrt(saa * sbb)
+    return np.where((saa > 0) & (sbb > 0), np.clip(rho, -1.0, 1.0), np.nan)
+
+# Spearman correlation of every column (axis=0) or row (axis=1) of x with the same one of y.
+# Vectors containing NaN are done one by one with spearmanr(nan_policy='omit').
+def spearman_along(x, y, axis=0):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if x.shape != y.shape:
+        raise ValueError(f"Matrices must be aligned, got shapes {x.shape} and {y.shape}")
+    if axis == 1:
+        x, y = x.T, y.T
+
+    missing = np.isnan(x).any(axis=0) | np.isnan(y).any(axis=0)
+    rho = np.full(x.shape[1], np.nan)
+    complete = ~missing
+    if complete.any():
+        rho[complete] = _columnwise_pearson(rankdata(x[:, complete], axis=0), rankdata(y[:, complete], axis=0))
+    for j in np.flatnonzero(missing):
+        keep = ~(np.isnan(x[:, j]) | np.isnan(y[:, j]))
+        if keep.sum() > 2 and np.ptp(x[keep, j]) > 0 and np.ptp(y[keep, j]) > 0:
+            rho[j] = spearmanr(x[keep, j], y[keep, j]).statistic
+    return rho
+
+# Percentile bootstrap CIs of spearman_along. Observations (rows for axis=0, columns for axis=1)
+# are resampled with replacement; resamples are ranked and correlated in batches whose stacked
+# copies stay under max_batch_bytes.
+def bootstrap_spearman(x, y, axis=0, n_boot=1000, level=0.95, seed=0, max_batch_bytes=256 * 1024 ** 2):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if axis == 1:
+        x, y = x.T, y.T
+    n, m = x.shape
+    rng = np.random.default_rng(seed)
+    batch = max(1, int(max_batch_bytes // (4 * 8 * n * max(m, 1))))
+
+    draws = np.empty((n_boot, m))
+    for start in range(0, n_boot, batch):
+        stop = min(start + batch, n_boot)
+        idx = rng.integers(0, n, size=(stop - start, n))
+        draws[start:stop] = _columnwise_pearson(rankdata(x[idx], axis=1), rankdata(y[idx], axis=1))
+
+    tail = (1 - level) / 2
+    with warnings.catch_warnings():
+        # constant columns have no finite resample
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, upper = np.nanquantile(draws, [tail, 1 - tail], axis=0)
+    return lower, upper
+
+# Long-format correlations of x and y (DataFrames with the same index and columns), one row per
+# column (axis=0) or row (axis=1), keeping only finite ones like the per-pair loops did
+def concordance_table(x, y, axis=0, name='Genus', n_boot=0, level=0.95, seed=0):
+    labels = x.columns if axis == 0 else x.index
+    rho = spearman_along(x.to_numpy(), y.to_numpy(), axis=axis)
+    table = pd.DataFrame({name: labels, 'Spearman_ρ': rho})
+    if n_boot:
+        lower, upper = bootstrap_spearman(x.to_numpy(), y.to_numpy(), axis=axis, n_boot=n_boot, level=level, seed=seed)
+        table['CI_lower'] = lower
+        table['CI_upper'] = upper
+    return table[np.isfinite(rho)].reset_index(drop=True)
+
+# Spearman correlation matrix of all columns of a frame, equal to frame.corr(method='spearman').
+# Columns are grouped by which rows they have values for; each pair of groups is ranked on their
+# shared rows and correlated in one matrix product, so complete data takes a single product.
+def spearman_matrix(frame):
+    values = frame.to_numpy(dtype=np.float64)
+    present = ~np.isnan(values)
+    patterns, group = np.unique(present, axis=1, return_inverse=True)
+    group = group.ravel()
+
+    rho = np.full((values.shape[1], values.shape[1]), np.nan)
+    for a in range(patterns.shape[1]):
+        for b in range(a, patterns.shape[1]):
+            rows = patterns[:, a] & patterns[:, b]
+            cols_a = np.flatnonzero(group == a)
+            cols_b = np.flatnonzero(group == b)
+            cols = np.concatenate([cols_a, cols_b]) if a != b else cols_a
+            ranks = rankdata(values[np.ix_(rows, cols)], axis=0)
+            ranks -= ranks.mean(axis=0)
+            norms = np.sqrt((ranks ** 2).sum(axis=0))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                block = (ranks.T @ ranks) / np.outer(norms, norms)
+            block = np.where(np.outer(norms, norms) > 0, np.clip(block, -1.0, 1.0), np.nan)
+            if a == b:
+                rho[np.ix_(cols, cols)] = block
+            else:
+                rho[np.ix_(cols_a, cols_b)] = block[:len(cols_a), len(cols_a):]
+                rho[np.ix_(cols_b, cols_a)] = block[len(cols_a):, :len(cols_a)]
+    return pd.DataFrame(rho, index=frame.columns, columns=frame.columns)
@@ -1,15 +1,20 @@
 import os
+import sys
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from scipy.stats import spearmanr
-import qiime2
-import biom
+from concordance import concordance_table
+
+# Shared helpers live in downstreamanalyses/microbiome_utils.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from microbiome_utils import read_biom_subset
 
 ### Settings
 cohort_name = "MrOS"   # change per cohort
 label_name  = "MrOS"   # label for figures and legends
+n_bootstrap = 0        # bootstrap resamples for CI_lower/CI_upper columns (0 = no CIs)
+ci_level    = 0.95
 
 ### Input files
 prev_file_16S = f"{cohort_name}_16S_Prev_Abundance_per_genus.csv"
@@ -80,9 +85,9 @@ print(f"Shared genera passing prevalence threshold: {len(genera)}")
 if len(genera) == 0:
     raise ValueError("No shared genera passing the prevalence threshold; cannot proceed.")
 
-### Load genus-level tables from QIIME 2 artifacts
-table_16S = qiime2.Artifact.load(qza_file_16S).view(biom.Table).to_dataframe()
-table_WGS = qiime2.Artifact.load(qza_file_WGS).view(biom.Table).to_dataframe()
+### Load only the shared genera from the genus-level QIIME 2 artifacts
+table_16S = read_biom_subset(qza_file_16S, observation_ids=genera).to_dataframe()
+table_WGS = read_biom_subset(qza_file_WGS, observation_ids=genera).to_dataframe()
 
 if hasattr(table_16S, "sparse"):
     table_16S = table_16S.sparse.to_dense()
@@ -115,17 +120,7 @@ genera = list(table_16S.columns)
 print(f"Genera retained after zero-sum check: {len(genera)}")
 
 ### Per-genus correlations (across participants)
-genus_results = []
-for g in genera:
-    x = table_16S[g]
-    y = table_WGS[g]
-    if x.var() == 0 or y.var() == 0:
-        continue
-    ρ, _ = spearmanr(x, y, nan_policy="omit")
-    if np.isfinite(ρ):
-        genus_results.append({"Genus": g, "Spearman_ρ": ρ})
-
-genus_df = pd.DataFrame(genus_results)
+genus_df = concordance_table(table_16S, table_WGS, axis=0, name="Genus", n_boot=n_bootstrap, level=ci_level)
 if not genus_df.empty:
     genus_df.to_csv(out_genus_csv, index=False)
     print(f"Saved per-genus correlations: {out_genus_csv}")
@@ -133,19 +128,7 @@ else:
     print("No valid genera for correlation.")
 
 ### Per-participant correlations (across genera)
-sample_results = []
-X = table_16S[genera]
-Y = table_WGS[genera]
-for s in X.index:
-    xv = X.loc[s]
-    yv = Y.loc[s]
-    if xv.var() == 0 or yv.var() == 0:
-        continue
-    ρ, _ = spearmanr(xv, yv, nan_policy="omit")
-    if np.isfinite(ρ):
-        sample_results.append({"Sample": s, "Spearman_ρ": ρ})
-
-sample_df = pd.DataFrame(sample_results)
+sample_df = concordance_table(table_16S[genera], table_WGS[genera], axis=1, name="Sample", n_boot=n_bootstrap, level=ci_level)
 if not sample_df.empty:
     sample_df.to_csv(out_sample_csv, index=False)
     print(f"Saved per-participant correlations: {out_sample_csv}")
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+import pandas as pd
+
+# Current resident set size of this process in MB
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except OSError:
+        return float('nan')
+
+# Stage timers, peak-memory sampling and counters for one run. While any stage is open, a
+# background thread samples the RSS every `interval` seconds and raises the peak of all open
+# stages. A disabled profiler only checks a flag, so the calls stay in place for normal runs.
+class Profiler:
+    def __init__(self, enabled=False, interval=0.1):
+        self.enabled = enabled
+        self.interval = interval
+        self._reset()
+
+    def _reset(self):
+        self.records = []
+        self.counters = {}
+        self._active = []
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                rss = current_rss_mb()
+                for record in self._active:
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+            time.sleep(self.interval)
+
+    # Times the enclosed block; labels (e.g. level='genus') are kept as columns of the report
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        if not self.enabled:
+            yield
+            return
+        rss = current_rss_mb()
+        with self._lock:
+            path = '/'.join([record['stage'] for record in self._active] + [name])
+            record = {'stage': name, 'path': path, 'pid': os.getpid(), 'seconds': None,
+                      'start_rss_mb': rss, 'peak_rss_mb': rss, 'end_rss_mb': None, **labels}
+            self._active.append(record)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            rss = current_rss_mb()
+            with self._lock:
+                self._active.remove(record)
+                record['end_rss_mb'] = rss
+                record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+                self.records.append(record)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Records and counters since the last drain, for handing back from a pool worker
+    def drain(self):
+        with self._lock:
+            records, counters = self.records, self.counters
+            self.records, self.counters = [], {}
+        return records, counters
+
+    def merge(self, records, counters):
+        with self._lock:
+            self.records.extend(records)
+        for name, n in counters.items():
+            self.count(name, n)
+
+    # Writes <prefix>_profile.csv (one row per stage) and <prefix>_profile.json (stages, counters, process peak)
+    def write(self, prefix):
+        if not self.enabled:
+            return
+        report = pd.DataFrame(self.records)
+        report.to_csv(f"{prefix}_profile.csv", index=False)
+        with open(f"{prefix}_profile.json", 'w') as f:
+            json.dump({
+                'stages': self.records,
+                'counters': self.counters,
+                'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            }, f, indent=2, default=str)
+
+# Process-wide profiler, switched on by analysiscode.py (profile="yes")
+PROFILER = Profiler()
+
+# forked workers start with their own lock and no stages inherited from the parent
+os.register_at_fork(after_in_child=PROFILER._reset)
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('qiime2')
+import biom
+from skbio.diversity import alpha as skbio_alpha
+from microbiome_utils import alpha_diversities
+
+# The native metrics must equal scikit-bio's, which diversity.actions.alpha calls, for the
+# installed version (log base and evenness denominator changed between releases)
+def test_alpha_diversities_match_installed_skbio():
+    rng = np.random.default_rng(0)
+    counts = rng.negative_binomial(1, 0.2, (40, 25)) * (rng.random((40, 25)) < 0.4)
+    counts[:, 0] = 0
+    counts[:, 0][3] = 7  # a one-feature sample
+    table = biom.Table(counts.astype(float), [f'F{i}' for i in range(40)], [f'S{j}' for j in range(25)])
+    alpha = alpha_diversities(table)
+
+    for j, sample in enumerate(table.ids(axis='sample')):
+        column = counts[:, j]
+        assert alpha.loc[sample, 'shannon'] == pytest.approx(skbio_alpha.shannon(column), abs=1e-12)
+        assert alpha.loc[sample, 'chao1'] == pytest.approx(skbio_alpha.chao1(column, bias_corrected=True))
+        assert alpha.loc[sample, 'simpson'] == pytest.approx(skbio_alpha.simpson(column))
+        assert alpha.loc[sample, 'simpson_e'] == pytest.approx(skbio_alpha.simpson_e(column))
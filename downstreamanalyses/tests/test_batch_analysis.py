@@ -0,0 +1,61 @@
+import multiprocessing
+import pandas as pd
+import pytest
+import skbio
+
+pytest.importorskip('qiime2')
+import microbiome_utils
+import batch_analysis
+from microbiome_utils import load_taxonomy_index, load_unifrac_stage
+
+TAXONOMY = pd.DataFrame({'Taxon': ['d__B; p__F; c__C; o__O; f__L; g__A; s__A a', 'd__B; p__F; c__C; o__O; f__L; g__B; s__B b']},
+                        index=['f1', 'f2'])
+
+class FakeArtifact:
+    loads = []
+
+    def __init__(self, path):
+        self.path = path
+        self.uuid = f'uuid-{path}'
+
+    @classmethod
+    def load(cls, path):
+        cls.loads.append(path)
+        return cls(path)
+
+    def view(self, view_type):
+        if view_type is skbio.TreeNode:
+            return skbio.TreeNode.read(['(f1:1,f2:1);'])
+        return TAXONOMY
+
+@pytest.fixture
+def fake_artifacts(monkeypatch):
+    monkeypatch.setattr(microbiome_utils.qiime2, 'Artifact', FakeArtifact, raising=False)
+    FakeArtifact.loads = []
+    load_taxonomy_index.cache_clear()
+    load_unifrac_stage.cache_clear()
+    yield
+    load_taxonomy_index.cache_clear()
+    load_unifrac_stage.cache_clear()
+
+def _child(conn):
+    taxonomy_index = load_taxonomy_index('taxonomy.qza')
+    unifrac_stage = load_unifrac_stage('tree.qza')
+    conn.send((FakeArtifact.loads, taxonomy_index.uuid, sorted(unifrac_stage.tip_names)))
+
+# Cohorts forked after the preload get the parsed references without loading the artifacts again
+def test_forked_cohorts_reuse_preloaded_references(fake_artifacts):
+    jobs = [{'env': {'taxonomy': 'taxonomy.qza', 'tree': 'tree.qza'}} for _ in range(3)]
+    batch_analysis.load_shared_references(jobs)
+    assert FakeArtifact.loads == ['taxonomy.qza', 'tree.qza']
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=_child, args=(sender,))
+    child.start()
+    sender.close()
+    loads, taxonomy_uuid, tip_names = receiver.recv()
+    child.join()
+    assert loads == ['taxonomy.qza', 'tree.qza']
+    assert taxonomy_uuid == 'uuid-taxonomy.qza'
+    assert tip_names == ['f1', 'f2']
@@ -0,0 +1,86 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('qiime2')
+lifelines = pytest.importorskip('lifelines')
+import association_utils
+from association_utils import cox_scan, run_unit, ColumnSchema
+
+FEATURES = [f'g__Genus_{i}' for i in range(6)]
+
+# ppump_1 is a binary covariate without any deaths, so its estimate has no finite maximum
+@pytest.fixture
+def datafile():
+    rng = np.random.default_rng(1)
+    n = 600
+    frame = pd.DataFrame({
+        'age': rng.uniform(40, 80, n),
+        'sex_women': rng.binomial(1, 0.5, n).astype(float),
+        'ppump_1': rng.binomial(1, 0.1, n).astype(float),
+    })
+    for i, feature in enumerate(FEATURES):
+        frame[feature] = rng.normal(size=n)
+    hazard = 0.02 * np.exp(0.05 * (frame['age'] - 60) + 0.3 * frame[FEATURES[0]])
+    death = rng.exponential(1 / hazard)
+    censor = rng.uniform(2, 15, n)
+    frame['mortality'] = ((death < censor) & (frame['ppump_1'] == 0)).astype(float)
+    frame['studytime'] = np.minimum(death, censor)
+    frame.attrs['feature_columns'] = FEATURES
+    return frame
+
+def lifelines_fit(datafile, covariates, var):
+    data = datafile[covariates + [var]].copy()
+    data['followup'] = datafile['studytime'] + datafile['age']
+    data['mortality'] = datafile['mortality']
+    cph = lifelines.CoxPHFitter().fit(data, duration_col='followup', event_col='mortality')
+    return cph.summary.loc[var]
+
+def test_covariate_without_events_keeps_every_feature(datafile):
+    assert datafile.loc[datafile['ppump_1'] == 1, 'mortality'].sum() == 0
+    covariates = ['sex_women', 'ppump_1']
+    scan, failures = cox_scan(datafile, covariates, FEATURES)
+    assert failures == []
+    assert list(scan.index) == FEATURES
+    for var in FEATURES:
+        expected = lifelines_fit(datafile, covariates, var)
+        assert scan.loc[var, 'Coefficient'] == pytest.approx(expected['coef'], abs=1e-5)
+        assert scan.loc[var, 'Std.Error'] == pytest.approx(expected['se(coef)'], rel=1e-4)
+
+def test_failed_batched_fits_are_refitted_with_lifelines(datafile, monkeypatch):
+    original = association_utils.cox_scan
+
+    def failing_scan(datafile, covariate_cols, variables):
+        scan, failures = original(datafile, covariate_cols, variables)
+        return scan.drop(index=FEATURES[2]), failures + [{'Variable': FEATURES[2], 'reason': 'test'}]
+
+    monkeypatch.setattr(association_utils, 'cox_scan', failing_scan)
+    schema = ColumnSchema(['sampleid', 'age', 'sex', 'ppump', 'mortality', 'studytime'])
+    frame = run_unit(datafile.copy(), 'all', 'mortality', 'sex+ppump', schema)
+    assert list(frame['Variable']) == FEATURES
+    expected = lifelines_fit(datafile, ['sex_women', 'ppump_1'], FEATURES[2])
+    refitted = frame.set_index('Variable').loc[FEATURES[2]]
+    assert refitted['Coefficient'] == pytest.approx(expected['coef'])
+
+def test_lifelines_failures_are_logged(datafile, monkeypatch, caplog):
+    monkeypatch.setattr(association_utils, 'cox_scan', lambda datafile, covariate_cols, variables: (
+        pd.DataFrame(columns=['N', 'Ncases', 'Coefficient', 'Std.Error', 'HR', 'LL', 'UL', 'P']),
+        [{'Variable': FEATURES[2], 'reason': 'test'}]
+    ))
+
+    class FailingFitter(lifelines.CoxPHFitter):
+        def fit(self, df, *args, **kwargs):
+            raise ValueError('no convergence')
+
+    monkeypatch.setattr(association_utils, 'CoxPHFitter', FailingFitter)
+    schema = ColumnSchema(['sampleid', 'age', 'sex', 'ppump', 'mortality', 'studytime'])
+    with caplog.at_level('INFO', logger='agingmicrobiome.association'):
+        frame = run_unit(datafile.copy(), 'all', 'mortality', 'sex+ppump', schema)
+    assert frame.empty
+    events = [json.loads(record.getMessage()) for record in caplog.records]
+    failed = [event for event in events if event['event'] == 'cox_fit_failed']
+    assert failed == [{
+        'event': 'cox_fit_failed', 'Datasplit': 'all', 'Outcome': 'mortality', 'Model': 'sex+ppump',
+        'Variable': FEATURES[2], 'covariates': ['sex_women', 'ppump_1', FEATURES[2]], 'error': 'no convergence'
+    }]
@@ -0,0 +1,62 @@
+import os
+import contextlib
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('qiime2')
+pytest.importorskip('lifelines')
+import association_utils
+from association_utils import run_units_parallel
+
+UNITS = [('all', 'bmi', 'sex'), ('fail', 'bmi', 'sex'), ('men', 'bmi', 'sex')]
+
+def fake_process_precomputed(meta, features, model, sub, out, factors):
+    if sub == 'fail':
+        raise RuntimeError('worker failed')
+    return features
+
+def fake_run_unit(datafile, subs, out, model, schema, **options):
+    return pd.DataFrame({'Datasplit': [subs], 'N': [len(datafile)]})
+
+@pytest.fixture
+def shared_names(monkeypatch):
+    monkeypatch.setattr(association_utils, 'process_precomputed', fake_process_precomputed)
+    monkeypatch.setattr(association_utils, 'run_unit', fake_run_unit)
+    names = []
+    original = association_utils.SharedFrame.__init__
+
+    def recording_init(self, frame):
+        original(self, frame)
+        names.append(self.name)
+
+    monkeypatch.setattr(association_utils.SharedFrame, '__init__', recording_init)
+    return names
+
+@pytest.fixture
+def features():
+    return pd.DataFrame(np.random.default_rng(0).random((20, 3)), index=[f's{i}' for i in range(20)], columns=['a', 'b', 'c'])
+
+def released(name):
+    return not os.path.exists(os.path.join('/dev/shm', name))
+
+def test_worker_error_releases_shared_frame(shared_names, features):
+    with pytest.raises(RuntimeError, match='worker failed'):
+        with contextlib.closing(run_units_parallel(UNITS, None, features, ['NA'], None, 2)) as results:
+            list(results)
+    assert len(shared_names) == 1
+    assert released(shared_names[0])
+
+def test_consumer_error_releases_shared_frame(shared_names, features):
+    with pytest.raises(ValueError):
+        with contextlib.closing(run_units_parallel(UNITS[:1], None, features, ['NA'], None, 2)) as results:
+            for unit_frame in results:
+                raise ValueError('collecting the unit failed')
+    assert released(shared_names[0])
+
+def test_results_in_unit_order(shared_names, features):
+    units = [UNITS[0], UNITS[2]] * 3
+    with contextlib.closing(run_units_parallel(units, None, features, ['NA'], None, 3)) as results:
+        frames = list(results)
+    assert [frame['Datasplit'][0] for frame in frames] == [unit[0] for unit in units]
+    assert released(shared_names[0])